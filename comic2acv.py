@@ -1,16 +1,20 @@
 #!/usr/bin/env python2
 
 import argparse
+import cStringIO
+import collections
+import multiprocessing
 import os
 import pdb
 import re
 import shutil
-import subprocess
 import sys
 import tempfile
 import traceback
+import zipfile
 
-from mcomix.image_tools import get_most_common_edge_colour
+from mcomix import constants
+from mcomix import frame_detection
 from mcomix.smart_scroller import SmartScroller
 
 from libs.comic_book import MComixBook
@@ -30,85 +34,167 @@ parser.add_argument('-d', '--display', type=display,
 parser.add_argument('-D', '--downscale', type=int,
                     dest='downscale', metavar='SIZE', default=None,
                     help='will downscale images to under SIZExSIZE')
+parser.add_argument('-s', '--detect-scale', type=int,
+                    dest='detect_scale', metavar='N', default=1,
+                    help='detect frames on pages downscaled by N (faster, less precise)')
+parser.add_argument('-j', '--jobs', type=int,
+                    dest='jobs', metavar='N', default=1,
+                    help='number of processes used for converting pages')
 parser.add_argument('-o', '--output',
                     dest='output', metavar='FILE', default=None,
-                    help='output file path')
-parser.add_argument('comic', nargs=1, help='path to comic archive to convert')
+                    help='output file path (only valid with a single comic)')
+parser.add_argument('comics', nargs='+', metavar='comic',
+                    help='path to comic archive to convert')
 
 options = parser.parse_args(sys.argv[1:])
-options.comic = unicode(options.comic[0])
+options.comics = [unicode(path) for path in options.comics]
 
-if options.output is None:
-    base, ext = os.path.splitext(options.comic)
-    options.output = base + '.acv'
+if options.output is not None and len(options.comics) > 1:
+    parser.error('--output can only be used with a single comic')
 
-if os.path.exists(options.output):
-    print >>sys.stderr, 'output already exists: %s' % options.output
-    sys.exit(1)
+if options.display:
+    view_width, view_height = options.display
+else:
+    view_width, view_height = 0, 0
 
-cleanup = []
-try:
+class ConversionError(Exception):
+
+    def __init__(self, message, status):
+        Exception.__init__(self, message)
+        self.status = status
+
+def downscaled_size(size, downscale):
+    """ Return the size of a page of <size> downscaled to fit under
+    <downscale>x<downscale> (if not None). """
+    width, height = size
+    if downscale:
+        max_size = downscale
+        if width > max_size:
+            height *= float(max_size) / width
+            width = max_size
+        if height > max_size:
+            width *= float(max_size) / height
+            height = max_size
+        width = int(round(width))
+        height = int(round(height))
+    return width, height
+
+def convert_page(image_data, image_path, downscale, detect_scale):
+    """ Decode and detect the background color and frames of a page, the
+    page is only saved to <image_path> if downscaled. Run by worker
+    processes, so only return plain tuples. """
+    original_size = []
+    def target_size(size):
+        original_size.append(size)
+        return downscaled_size(size, downscale)
 
-    scroller = SmartScroller()
-
-    tmpdir = tempfile.mkdtemp(prefix=u'comic2acv.')
-    cleanup.append(lambda: shutil.rmtree(tmpdir, True))
-
-    comic = MComixBook(options.comic)
-    cleanup.append(comic.close)
-
-    if 0 == len(comic):
-        print >>sys.stderr, 'no images found in comic: %s' % options.comic
-        sys.exit(2)
-
-    acv_xml = open(os.path.join(tmpdir, 'acv.xml'), 'wb')
-    cleanup.append(acv_xml.close)
-    acv_xml.write('<comic>\n')
-
-    manifest_path = os.path.join(tmpdir, 'manifest')
-    manifest = open(manifest_path, 'w+b')
-    cleanup.append(manifest.close)
-    manifest.write(os.path.join(tmpdir, 'acv.xml') + '\n')
-
-    for n in xrange(len(comic)):
-        print 'processing page %u: %s' % (n, comic.get_filename(n))
-        image_path = os.path.join(tmpdir, comic.get_filename(n))
-        image_data = comic.get_file(n).read()
-        image = Image.from_string(image_data)
-        width, height = image.size
-
-        if options.downscale:
-            max_size = options.downscale
-            if width > max_size:
-                height *= float(max_size) / width
-                width = max_size
-            if height > max_size:
-                width *= float(max_size) / height
-                height = max_size
-            width = int(round(width))
-            height = int(round(height))
+    # Let the decoder downscale too if it can.
+    image = Image.from_string(image_data, target_size=target_size)
+    if not original_size:
+        original_size.append(image.size)
+    width, height = downscaled_size(original_size[0], downscale)
 
+    if (width, height) != original_size[0]:
+        print 'downscaling image from %ux%u to %ux%u' % (
+            original_size[0][0], original_size[0][1], width, height)
         if (width, height) != image.size:
-            print 'downscaling image from %ux%u to %ux%u' % (
-                image.size[0], image.size[1], width, height)
             image = image.resize((width, height))
-
         image.save(image_path)
+        saved = True
+    else:
+        saved = False
 
-        if options.display:
-            view_width, view_height = options.display
-        else:
-            view_width, view_height = 0, 0
+    bgcolor, frames = frame_detection.detect(image.to_pil(),
+                                             luminance=image.to_luminance(),
+                                             scale=detect_scale)
+    return (width, height), tuple(bgcolor), [tuple(f.rect) for f in frames], saved
+
+class Book(object):
+    """ A comic being converted. """
+
+    def __init__(self, path, output=None):
+        self.path = path
+        if output is None:
+            base, ext = os.path.splitext(path)
+            output = base + '.acv'
+        self.output = output
+        self.failed = False
+        self._finished = False
+        self._cleanup = []
+        try:
+            self._open()
+        except:
+            self.close()
+            raise
+
+    def _open(self):
+        if os.path.exists(self.output):
+            raise ConversionError('output already exists: %s' % self.output, 1)
+
+        self.tmpdir = tempfile.mkdtemp(prefix=u'comic2acv.')
+        self._cleanup.append(lambda: shutil.rmtree(self.tmpdir, True))
+
+        self.comic = MComixBook(self.path)
+        self._cleanup.append(self.comic.close)
+
+        if 0 == len(self.comic):
+            raise ConversionError('no images found in comic: %s' % self.path, 2)
+
+        # Pages from different sub-archives can share the same name, but
+        # the output can't have duplicate entries: number all pages then,
+        # so they still sort in order.
+        self.names = [self.comic.get_filename(n) for n in xrange(len(self.comic))]
+        if len(set(self.names)) != len(self.names):
+            width = len(str(len(self.names) - 1))
+            self.names = ['%0*u-%s' % (width, n, name)
+                          for n, name in enumerate(self.names)]
+
+        self.acv_xml = cStringIO.StringIO()
+        self.acv_xml.write('<comic>\n')
+
+        # Pages are written as soon as converted, acv.xml last.
+        self.zip = zipfile.ZipFile(self.output, 'w', zipfile.ZIP_DEFLATED, True)
+        self._cleanup.append(self._close_zip)
+
+    def _close_zip(self):
+        self.zip.close()
+        if not self._finished:
+            os.unlink(self.output)
 
-        manifest.write(image_path + '\n')
+    def __len__(self):
+        return len(self.comic)
 
-        pil_image = image.to_pil()
-        bgcolor = get_most_common_edge_colour(pil_image)
-        scroller.setup_image(pil_image, bgcolor)
-        acv_xml.write(' <screen index="%u" bgcolor="#%02x%02x%02x">\n' % (n,
-                                                                          bgcolor[0],
-                                                                          bgcolor[1],
-                                                                          bgcolor[2]))
+    def read_page(self, n):
+        """ Return a (image_data, image_path) tuple for page <n>. """
+        name = self.comic.get_filename(n)
+        print 'processing page %u: %s' % (n, name)
+        # Pages from different sub-archives can share the same name:
+        # prefix the page number so each one gets its own temporary file.
+        image_path = os.path.join(self.tmpdir, '%u-%s' % (n, name))
+        return self.comic.get_file(n).read(), image_path
+
+    def write_page(self, n, image_data, image_path, saved):
+        """ Add page <n> to the output: the downscaled image saved to
+        <image_path> if <saved>, else a copy of the original <image_data>. """
+        name = self.names[n]
+        if constants.COMPRESSED_IMAGE_REGEX.search(name):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        if saved:
+            self.zip.write(image_path, name, compress_type)
+            os.unlink(image_path)
+        else:
+            self.zip.writestr(name, image_data, compress_type)
+
+    def write_screen(self, n, size, bgcolor, frames):
+        width, height = size
+        scroller = SmartScroller()
+        scroller._frames = frames
+        self.acv_xml.write(' <screen index="%u" bgcolor="#%02x%02x%02x">\n' % (n,
+                                                                               bgcolor[0],
+                                                                               bgcolor[1],
+                                                                               bgcolor[2]))
         fn = 0
         while fn < len(scroller._frames):
             f = scroller._frames[fn]
@@ -132,23 +218,110 @@ try:
             y = float(y) / height
             w = float(w) / width
             h = float(h) / height
-            acv_xml.write('  <frame relativeArea="%f %f %f %f"/>\n' % (x, y, w, h))
+            self.acv_xml.write('  <frame relativeArea="%f %f %f %f"/>\n' % (x, y, w, h))
             fn = scroller._current_frames[1] + 1
-        acv_xml.write(' </screen>\n')
-    acv_xml.write('</comic>\n')
-    acv_xml.close()
+        self.acv_xml.write(' </screen>\n')
+
+    def finish(self):
+        self.acv_xml.write('</comic>\n')
+        print 'creating final %s' % self.output
+        self.zip.writestr('acv.xml', self.acv_xml.getvalue())
+        self.zip.close()
+        self._finished = True
+
+    def close(self):
+        for fn in reversed(self._cleanup):
+            fn()
+        self._cleanup = []
+
+status = 0
+
+def book_failed(book, status_code):
+    global status
+    if 0 == status:
+        status = status_code
+    if book is not None:
+        book.failed = True
+        book.close()
 
-    manifest.seek(0)
+cleanup = []
+try:
+
+    # Create the pool first: before any thread is started.
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        cleanup.append(pool.join)
+        cleanup.append(pool.terminate)
+    else:
+        pool = None
+
+    def submit(*args):
+        """ Queue conversion of a page, return a function to get the result. """
+        if pool is None:
+            result = convert_page(*args)
+            return lambda: result
+        return pool.apply_async(convert_page, args).get
 
-    print 'creating final %s' % options.output
-    retcode = subprocess.call(['zip', '-9', options.output,
-                               '--junk-path', '-@'],
-                              stdin=manifest)
-    if 0 != retcode:
-        sys.exit(retcode)
+    # Queue of (book, page, image_data, image_path, get_result) entries,
+    # across all books, so workers are kept busy while starting a new
+    # book. A page of None marks the end of a book.
+    pending = collections.deque()
+
+    def flush_pending(max_pending):
+        while len(pending) > max_pending:
+            book, n, image_data, image_path, get_result = pending.popleft()
+            if book.failed:
+                continue
+            try:
+                if n is None:
+                    book.finish()
+                    book.close()
+                    continue
+                size, bgcolor, rects, saved = get_result()
+                book.write_page(n, image_data, image_path, saved)
+                book.write_screen(n, size, bgcolor,
+                                  frame_detection.frames_from_rects(rects))
+            except ConversionError, e:
+                print >>sys.stderr, e
+                book_failed(book, e.status)
+            except Exception, e:
+                traceback.print_exc()
+                print >>sys.stderr, 'failed to convert: %s' % book.path
+                book_failed(book, 1)
+
+    for path in options.comics:
+        book = None
+        try:
+            book = Book(path, output=options.output)
+            cleanup.append(book.close)
+            if len(options.comics) > 1:
+                print 'converting %s' % path
+            for n in xrange(len(book)):
+                image_data, image_path = book.read_page(n)
+                get_result = submit(image_data, image_path, options.downscale,
+                                    options.detect_scale)
+                pending.append((book, n, image_data, image_path, get_result))
+                # Limit the number of pending pages.
+                flush_pending(2 * options.jobs)
+                if book.failed:
+                    break
+        except ConversionError, e:
+            print >>sys.stderr, e
+            book_failed(book, e.status)
+            continue
+        except Exception, e:
+            traceback.print_exc()
+            print >>sys.stderr, 'failed to convert: %s' % path
+            book_failed(book, 1)
+            continue
+        pending.append((book, None, None, None, None))
+
+    flush_pending(0)
 
 finally:
     # print traceback.format_exc()
     # pdb.post_mortem()
     for fn in reversed(cleanup):
         fn()
+
+sys.exit(status)
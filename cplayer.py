@@ -44,6 +44,16 @@ if __name__ == "__main__":
                         default='warning', help='set log level')
     parser.add_argument('-d', '--debug', action='store_const', const='debug',
                         dest='log_level', help='shortcut for -l debug')
+    parser.add_argument('--prefetch-ahead', type=int, metavar='N', default=2,
+                        help='number of pages to prepare ahead of the current one')
+    parser.add_argument('--prefetch-behind', type=int, metavar='N', default=1,
+                        help='number of pages to prepare behind the current one')
+    parser.add_argument('--prepare-threads', type=int, metavar='N', default=2,
+                        help='number of threads used for preparing pages (0: number of CPUs)')
+    parser.add_argument('--detect-processes', type=int, metavar='N', default=0,
+                        help='number of processes used for detecting frames (0: no process)')
+    parser.add_argument('--detect-scale', type=int, metavar='N', default=1,
+                        help='detect frames on pages downscaled by N (faster, less precise)')
     parser.add_argument('comics', nargs='+')
 
     options = parser.parse_args(portability.get_commandline_args())
@@ -52,7 +62,12 @@ if __name__ == "__main__":
     log.setLevel(options.log_level.upper())
 
     try:
-        dapp = libs.displayer.DisplayerApp(options.comics)
+        dapp = libs.displayer.DisplayerApp(options.comics,
+                                           prefetch_ahead=options.prefetch_ahead,
+                                           prefetch_behind=options.prefetch_behind,
+                                           prepare_threads=options.prepare_threads or None,
+                                           detect_processes=options.detect_processes,
+                                           detect_scale=options.detect_scale)
         dapp.run()
     except:
         print >>sys.stderr, traceback.format_exc()
@@ -31,6 +31,7 @@ import tempfile
 import shutil
 import glob
 import re
+import cStringIO
 
 from xml.etree import ElementTree
 
@@ -39,19 +40,51 @@ from mcomix.worker_thread import WorkerThread
 from mcomix.tools import alphanumeric_sort
 from mcomix import log
 
+from page_cache import comic_key, get_page_cache, parse_color
+
 img_extensions = ['jpeg', 'jpg', 'gif', 'png']
 
+# Maximum size (in bytes) of extracted pages kept in memory by MComixBook,
+# pages that don't fit are written to its temporary directory instead.
+MAX_MEMORY_STORE_SIZE = 128 * 1024 * 1024
+
+# Maximum number of pages extracted together, for archives where
+# extracting several pages at once is cheaper (e.g. a single process
+# spawned for all of them).
+MAX_EXTRACT_BATCH_SIZE = 8
+
+# Number of pages after the current one whose extraction is prioritized.
+EXTRACT_READ_AHEAD = 16
+
 class UnsupportedFileTypeError:
     pass
 
-def ComicBook(path):
+def _get_cached_toc(path):
+    """ Return the cached (type, state) table of contents of the archive at
+    <path>, or None. """
+    page_cache = get_page_cache()
+    if page_cache is None:
+        return None
+    key = comic_key(path)
+    if key is None:
+        return None
+    return page_cache.get_toc(key)
+
+def ComicBook(path, lazy_listing=False):
     if not os.path.isfile(path):
         if os.path.isdir(path):
             return DirComicBook(path)
         raise ValueError('invalid file path')
     else:
-        if archive_mime_type(path) is not None:
-            return MComixBook(path)
+        # The archive type is only needed if its table of contents is
+        # not cached, pass them along so MComixBook does not look again.
+        toc = _get_cached_toc(path)
+        archive_type = None
+        if toc is None:
+            archive_type = archive_mime_type(path)
+        if toc is not None or archive_type is not None:
+            return MComixBook(path, lazy_listing=lazy_listing,
+                              toc=toc, archive_type=archive_type)
         ext = os.path.splitext(path)[1].lower()[1:]
         if ext in img_extensions:
             return SingleFileComicBook(path)
@@ -66,6 +99,15 @@ class BaseComicBook:
         self._comic_bgcolor = None
         self._page_bgcolor = {}
         self._page_frames = {}
+        self._page_cache = get_page_cache()
+        if self._page_cache is not None:
+            self._page_cache_key = comic_key(path)
+            if self._page_cache_key is None:
+                self._page_cache = None
+            else:
+                self._page_cache.touch(self._page_cache_key)
+        # Names of pages already looked up in the page cache.
+        self._page_cache_loaded = set()
 
     def close(self):
         pass
@@ -83,17 +125,54 @@ class BaseComicBook:
     def get_file(self, page):
         return self.get_file_by_name(self.filenames[page])
 
+    def is_listing_complete(self):
+        """ Returns True once all pages are known, see update_listing. """
+        return True
+
+    def update_listing(self, wait=False):
+        """ Pages may be listed in the background: filenames then grows as
+        they are found, in a provisional order. Once listing is complete
+        (waiting for it if <wait> is True), switch to the final page order,
+        and return a list mapping page indices in the previous order to
+        the new ones. Returns None if listing is not complete yet. """
+        return range(len(self.filenames))
+
+    def _load_cached_page(self, page):
+        """ Fill in page bgcolor/frames from the persistent page cache. """
+        if self._page_cache is None:
+            return
+        name = self.filenames[page]
+        if name in self._page_cache_loaded:
+            # Only look up missing pages once.
+            return
+        self._page_cache_loaded.add(name)
+        bgcolor, frames = self._page_cache.get(self._page_cache_key, name)
+        if bgcolor is not None and not page in self._page_bgcolor:
+            self._page_bgcolor[page] = bgcolor
+        if frames is not None and not page in self._page_frames:
+            self._page_frames[page] = frames
+
     def get_frames(self, page):
+        if not page in self._page_frames:
+            self._load_cached_page(page)
         return self._page_frames.get(page)
 
     def get_bgcolor(self, page):
+        if not page in self._page_bgcolor:
+            self._load_cached_page(page)
         return self._page_bgcolor.get(page, self._comic_bgcolor)
 
     def set_frames(self, page, frames):
         self._page_frames[page] = frames
+        if self._page_cache is not None:
+            self._page_cache.set_frames(self._page_cache_key,
+                                        self.filenames[page], frames)
 
     def set_bgcolor(self, page, bgcolor):
         self._page_bgcolor[page] = bgcolor
+        if self._page_cache is not None:
+            self._page_cache.set_bgcolor(self._page_cache_key,
+                                         self.filenames[page], bgcolor)
 
 class DirComicBook(BaseComicBook):
 
@@ -122,54 +201,225 @@ class SingleFileComicBook(BaseComicBook):
 
 class MComixBook(BaseComicBook):
 
-    def __init__(self, path):
+    def __init__(self, path, max_memory_store_size=MAX_MEMORY_STORE_SIZE,
+                 lazy_listing=False, toc=None, archive_type=None):
+        """ If <lazy_listing> is True, and the archive supports it, pages
+        are listed in the background: only wait for the first one to be
+        found (see update_listing). If already known, the cached table of
+        contents <toc>, or else the <archive_type>, can be passed. """
         BaseComicBook.__init__(self, path)
         self._tmpdir = tempfile.mkdtemp(prefix=u'comicplayer.')
-        self._archive = get_recursive_archive_handler(path, self._tmpdir)
-        self.filenames = []
-        for f in self._archive.list_contents():
-            if f == 'acv.xml':
-                self._parse_acv(f)
-                continue
-            ext = os.path.splitext(f)[1].lower()[1:]
-            if ext in img_extensions:
-                self.filenames.append(f)
-        alphanumeric_sort(self.filenames)
+        # In-memory page store: name -> (index, data).
+        self._memory_store = {}
+        self._memory_store_size = 0
+        self._max_memory_store_size = max_memory_store_size
+        # Pages mapped from the archive file: name -> buffer, not
+        # accounted in the memory store size.
+        self._mapped_pages = {}
+        self._current_index = 0
         self._condition = threading.Condition()
         self._extracted = set()
+        # Pages being extracted by the extraction threads.
+        self._extracting = set()
+        # Incremented on each page request, so later requests have
+        # priority over earlier ones.
+        self._extract_generation = 0
+        # Pages queued with a priority by _extract_all, and the number
+        # of the next page to queue for extraction in the background.
+        self._prioritized = set()
+        self._frontier = 0
+        # Only extracts the pages requested until the final page order
+        # is known, see _start_extraction.
+        self._extract_thread = None
+        # For solid archives, extracting a single file means decompressing
+        # everything before it: extract all pages in one pass instead,
+        # from this thread.
+        self._solid = False
+        self._solid_thread = None
+        # Final page order, once listing is complete, with the ACV data
+        # (if any) for it.
+        self._sorted_filenames = None
+        self._acv = None
+        # True once switched to the final page order.
+        self._listed = False
+        # Map page names to their number (in the current page order).
+        self._page_numbers = {}
+        self._listing_thread = None
+        # Type of the archive, if its table of contents must be cached.
+        self._archive_type = None
+        self._archive = None
+        if self._page_cache is not None:
+            if toc is None and archive_type is None:
+                toc = self._page_cache.get_toc(self._page_cache_key)
+            if toc is not None:
+                self._archive = self._open_cached_archive(*toc)
+        if self._archive is None:
+            if archive_type is None:
+                archive_type = archive_mime_type(path)
+            self._archive_type = archive_type
+            self._archive = get_recursive_archive_handler(path, self._tmpdir,
+                                                          type=self._archive_type)
+            if self._archive is None:
+                shutil.rmtree(self._tmpdir, True)
+                raise ValueError('unsupported archive: %s' % path)
+            if lazy_listing and self._archive.support_extraction_while_listing:
+                # The archive limits may only be known once listed (see
+                # RecursiveArchive): a single thread until then.
+                self._extract_thread = WorkerThread(self._extract,
+                                                    unique_orders=True,
+                                                    batch_size=1)
+                self._listing_thread = WorkerThread(self._list_contents, name='listing')
+                self._listing_thread.append_order(self._archive)
+                with self._condition:
+                    while 0 == len(self.filenames) and self._sorted_filenames is None:
+                        self._condition.wait()
+                return
+        self._list_contents(self._archive)
+        self.update_listing()
+
+    def _open_cached_archive(self, archive_type, state):
+        """ Open the archive using its cached type and listing state,
+        skipping detection and listing. Returns None on failure. """
+        archive = get_recursive_archive_handler(self.path, self._tmpdir,
+                                                type=archive_type)
+        if archive is None:
+            return None
+        try:
+            archive.set_listing_state(state)
+        except Exception, e:
+            log.warning('invalid cached listing for %s: %s', self.path, e)
+            archive.close()
+            return None
+        return archive
+
+    def _list_contents(self, archive):
+        """ Add pages of <archive> to filenames as they are found, then
+        compute the final page order. """
+        acv = None
+        try:
+            for f in archive.iter_contents():
+                if self._listing_thread is not None and self._listing_thread.must_stop():
+                    return
+                if f == 'acv.xml':
+                    acv = f
+                    continue
+                ext = os.path.splitext(f)[1].lower()[1:]
+                if ext in img_extensions:
+                    with self._condition:
+                        self._page_numbers[f] = len(self.filenames)
+                        self.filenames.append(f)
+                        self._condition.notifyAll()
+            if self._archive_type is not None and self._page_cache is not None:
+                state = archive.get_listing_state()
+                if state is not None:
+                    self._page_cache.set_toc(self._page_cache_key,
+                                             self._archive_type, state)
+            if acv is not None:
+                acv = self._parse_acv(acv)
+            self._solid = archive.is_solid()
+        finally:
+            # Even on failure: don't leave anybody waiting.
+            with self._condition:
+                sorted_filenames = list(self.filenames)
+                alphanumeric_sort(sorted_filenames)
+                self._sorted_filenames = sorted_filenames
+                self._acv = acv
+                self._condition.notifyAll()
+
+    def is_listing_complete(self):
+        return self._sorted_filenames is not None
+
+    def update_listing(self, wait=False):
+        with self._condition:
+            if self._listed:
+                return range(len(self.filenames))
+            while wait and self._sorted_filenames is None:
+                self._condition.wait()
+            if self._sorted_filenames is None:
+                return None
+            index = dict([(name, n) for n, name in enumerate(self._sorted_filenames)])
+            mapping = [index[name] for name in self.filenames]
+            self._page_bgcolor = dict([(mapping[page], bgcolor) for page, bgcolor
+                                       in self._page_bgcolor.iteritems()])
+            self._page_frames = dict([(mapping[page], frames) for page, frames
+                                      in self._page_frames.iteritems()])
+            for name, (page, data) in self._memory_store.items():
+                self._memory_store[name] = (index[name], data)
+            if self._current_index < len(mapping):
+                self._current_index = mapping[self._current_index]
+            self.filenames = self._sorted_filenames
+            self._page_numbers = index
+            if self._acv is not None:
+                self._comic_bgcolor, self._page_bgcolor, self._page_frames = self._acv
+            self._listed = True
+            self._start_extraction()
+        return mapping
+
+    def _start_extraction(self):
+        """ Start extracting the book in the background, once the final
+        page order is known. """
+        if self._solid:
+            if self._extract_thread is not None:
+                # Pages requested while listing, and not started yet.
+                self._extract_thread.clear_orders()
+            names = [name for name in self.filenames if not name in self._extracted
+                     and not name in self._extracting]
+            self._solid_thread = WorkerThread(self._extract_solid)
+            self._solid_thread.append_order(tuple(names))
+            return
         if self._archive.support_concurrent_extractions:
-            max_threads = 2
+            # Limited by the archive type, or the number of CPUs.
+            max_threads = self._archive.max_concurrent_extractions
         else:
             max_threads = 1
-        self._extract_thread = WorkerThread(self._extract,
-                                            unique_orders=True,
-                                            max_threads=max_threads)
-        self._extract_all(0)
+        if self._archive.support_batch_extractions:
+            batch_size = MAX_EXTRACT_BATCH_SIZE
+        else:
+            batch_size = 1
+        if self._extract_thread is None:
+            self._extract_thread = WorkerThread(self._extract,
+                                                unique_orders=True,
+                                                max_threads=max_threads,
+                                                batch_size=batch_size)
+        else:
+            # Started while listing: resize for the archive limits.
+            self._extract_thread.set_batch_size(batch_size)
+            self._extract_thread.set_max_threads(max_threads)
+        # Pages around the requested ones first, then the rest of the book
+        # in order, queued a few at a time as extractions are done.
+        self._extract_all(self._current_index)
+        self._advance_frontier(EXTRACT_READ_AHEAD)
 
     def close(self):
-        self._extract_thread.stop()
+        if self._listing_thread is not None:
+            self._listing_thread.stop()
+        if self._extract_thread is not None:
+            self._extract_thread.stop()
+        if self._solid_thread is not None:
+            self._solid_thread.stop()
         self._archive.close()
+        self._memory_store = {}
+        self._memory_store_size = 0
+        self._mapped_pages = {}
         shutil.rmtree(self._tmpdir, True)
 
-    def _parse_bgcolor(self, color):
-        if not re.match('^#[0-9a-fA-F]{6}$', color):
-            return None
-        bgcolor = (int(color[1:3], 16),
-                   int(color[3:5], 16),
-                   int(color[5:7], 16))
-        return bgcolor
-
     def _parse_acv(self, name):
+        """ Parse ACV file <name>, returns a (comic_bgcolor, page_bgcolor,
+        page_frames) tuple, or None if invalid. """
         log.info('parsing ACV: %s', name)
-        self._archive.extract(name, self._tmpdir)
-        tree = ElementTree.parse(os.path.join(self._tmpdir, name))
+        data = self._archive.extract_to_buffer(name)
+        if data is None:
+            self._archive.extract(name, self._tmpdir)
+            tree = ElementTree.parse(os.path.join(self._tmpdir, name))
+        else:
+            tree = ElementTree.parse(cStringIO.StringIO(data))
         comic = tree.getroot()
         if 'comic' != comic.tag:
             log.error('ACV parser: root element is not comic: %s', comic.tag)
             return
         comic_bgcolor = None
         if 'bgcolor' in comic.attrib:
-            bgcolor = self._parse_bgcolor(comic.attrib['bgcolor'])
+            bgcolor = parse_color(comic.attrib['bgcolor'])
             if bgcolor is None:
                 log.error('invalid comic bgcolor: %s', comic.attrib['bgcolor'])
                 return
@@ -187,7 +437,7 @@ class MComixBook(BaseComicBook):
                 log.error('duplicate screen %u', page_number)
                 return
             if 'bgcolor' in screen.attrib:
-                bgcolor = self._parse_bgcolor(screen.attrib['bgcolor'])
+                bgcolor = parse_color(screen.attrib['bgcolor'])
                 if bgcolor is None:
                     log.error('invalid screen bgcolor: %s', screen.attrib['bgcolor'])
                     return
@@ -210,18 +460,18 @@ class MComixBook(BaseComicBook):
                         return
                 frame_list.append(area)
             page_frames[page_number] = frame_list
-        self._comic_bgcolor = comic_bgcolor
-        self._page_bgcolor = page_bgcolor
-        self._page_frames = page_frames
+        return comic_bgcolor, page_bgcolor, page_frames
 
     def _extract_all(self, priority_index):
-        self._extract_thread.clear_orders()
+        if self._solid:
+            # Already extracting everything, in archive order.
+            return
+        self._extract_generation += 1
         priority_files = []
         for r in (
             (priority_index, 2),
             (priority_index - 1, 1),
-            (priority_index + 2, len(self.filenames)),
-            (0, priority_index - 1),
+            (priority_index + 2, EXTRACT_READ_AHEAD - 1),
         ):
           s, l = r
           if s >= len(self.filenames):
@@ -236,19 +486,127 @@ class MComixBook(BaseComicBook):
           for name in self.filenames[s:s+l]:
               if not name in self._extracted:
                   priority_files.append(name)
-        self._extract_thread.extend_orders(priority_files)
-
-    def _extract(self, name):
-        self._archive.extract(name, self._tmpdir)
+        self._prioritized.update(priority_files)
+        # Requeue (if needed) and reprioritize: the previous orders
+        # are kept, with a lower priority.
+        priorities = [(-self._extract_generation, n) for n in range(len(priority_files))]
+        self._extract_thread.extend_orders(priority_files, priorities=priorities)
+
+    def _advance_frontier(self, count):
+        """ Queue the next <count> pages not extracted yet (in book order)
+        for extraction in the background. Must be called with
+        self._condition held. """
+        names = []
+        while len(names) < count and self._frontier < len(self.filenames):
+            name = self.filenames[self._frontier]
+            self._frontier += 1
+            # Don't lower the priority of pages already queued.
+            if not name in self._extracted and not name in self._prioritized:
+                names.append(name)
+        if 0 == len(names):
+            return
+        priorities = [(0, self._page_numbers[name]) for name in names]
+        self._extract_thread.extend_orders(names, priorities=priorities)
+
+    def _write_page(self, name, data):
+        """ Write page <name> to the temporary directory. """
+        path = os.path.join(self._tmpdir, name)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    def _spill_page(self, name):
+        """ Move page <name> from the memory store to the temporary directory. """
+        index, data = self._memory_store.pop(name)
+        self._memory_store_size -= len(data)
+        self._write_page(name, data)
+
+    def _store_page(self, name, data):
+        """ Keep extracted page <name> in memory, making room by spilling
+        the pages farthest from the current one to disk. Returns False if
+        the page itself is the farthest one and should go to disk. """
+        index = self._page_numbers[name]
+        distance = abs(index - self._current_index)
+        while self._memory_store_size + len(data) > self._max_memory_store_size:
+            if 0 == len(self._memory_store):
+                return False
+            farthest = max(self._memory_store,
+                           key=lambda n: abs(self._memory_store[n][0] - self._current_index))
+            if abs(self._memory_store[farthest][0] - self._current_index) <= distance:
+                return False
+            self._spill_page(farthest)
+        self._memory_store[name] = (index, data)
+        self._memory_store_size += len(data)
+        return True
+
+    def _extract(self, names):
         with self._condition:
-            self._extracted.add(name)
-            self._condition.notify()
+            count = len(names)
+            if self._solid_thread is not None:
+                # Left to the single pass.
+                return
+            names = [name for name in names if not name in self._extracted
+                     and not name in self._extracting]
+            self._extracting.update(names)
+        try:
+            self._extract_pages(names)
+        finally:
+            with self._condition:
+                self._extracting.difference_update(names)
+                self._condition.notifyAll()
+                # Replace processed orders with the next background pages.
+                if self._listed and not self._solid:
+                    self._advance_frontier(count)
+
+    def _extract_pages(self, names):
+        for name, data in self._archive.iter_extract_to_buffer(names):
+            if data is None:
+                self._archive.extract(name, self._tmpdir)
+            with self._condition:
+                if isinstance(data, buffer):
+                    self._mapped_pages[name] = data
+                elif data is not None and not self._store_page(name, data):
+                    self._write_page(name, data)
+                self._extracted.add(name)
+                self._condition.notifyAll()
+            if self._extract_thread is not None and self._extract_thread.must_stop():
+                return
+
+    def _extract_solid(self, names):
+        """ Extract <names> in a single pass over the archive, waking up
+        readers as pages become available. """
+        try:
+            for name in self._archive.iter_extract(names, self._tmpdir):
+                with self._condition:
+                    self._extracted.add(name)
+                    self._condition.notifyAll()
+                if self._solid_thread.must_stop():
+                    return
+        except Exception, e:
+            log.error('solid extraction of %s failed: %s', self.path, e)
+        # Don't leave readers waiting on pages missed by the single pass.
+        for name in names:
+            if self._solid_thread.must_stop():
+                return
+            if not name in self._extracted:
+                log.warning('extracting missed page: %s', name)
+                self._extract_pages((name,))
 
     def get_file_by_name(self, name):
-        priority_index = self.filenames.index(name)
         with self._condition:
-            self._extract_all(priority_index)
+            self._current_index = self._page_numbers[name]
+            if self._listed:
+                self._extract_all(self._current_index)
+            elif not name in self._extracted:
+                self._extract_generation += 1
+                self._extract_thread.append_order(name, priority=(-self._extract_generation, 0))
             while not name in self._extracted:
                 self._condition.wait()
+            if name in self._mapped_pages:
+                return cStringIO.StringIO(self._mapped_pages[name])
+            if name in self._memory_store:
+                index, data = self._memory_store[name]
+                return cStringIO.StringIO(data)
         return open(os.path.join(self._tmpdir, name), 'rb')
-
@@ -32,9 +32,10 @@ import pygame.locals as pyg
 
 import math
 import os
+import threading
 import traceback
 
-from mcomix import image_tools
+from mcomix import frame_detection
 from mcomix import log
 from mcomix.smart_scroller import Frame, Rect, SmartScroller
 from mcomix.worker_thread import WorkerThread
@@ -46,12 +47,21 @@ from displayer_renderer import Renderer
 
 class DisplayerApp:
 
-    CURSOR_HIDE, CACHE_NEXT_PAGE = xrange(pygame.USEREVENT, pygame.USEREVENT + 2)
+    CURSOR_HIDE, CACHE_PAGES = xrange(pygame.USEREVENT, pygame.USEREVENT + 2)
 
     VIEW_1_1, VIEW_WIDTH, VIEW_WIDEN_5_4 = xrange(3)
     ZOOM_IN, ZOOM_OFF, ZOOM_OUT = xrange(3)
 
-    def __init__(self, comics):
+    def __init__(self, comics, prefetch_ahead=2, prefetch_behind=1, prepare_threads=2,
+                 detect_processes=0, detect_scale=1):
+        # Must be created first: before pygame initialization,
+        # and before any thread is started.
+        if detect_processes > 0:
+            self.detection_pool = frame_detection.DetectionPool(detect_processes)
+        else:
+            self.detection_pool = None
+        # Frames are detected on pages downscaled by that factor.
+        self.detect_scale = detect_scale
         pygame.font.init()
         try:
             font = pygame.font.Font('resources'+os.sep+'DejaVuSansCondensed-Bold.ttf', 18)
@@ -70,6 +80,23 @@ class DisplayerApp:
         pygame.time.set_timer(self.CURSOR_HIDE, 2000)
 
         self.cleaner_thread = WorkerThread(self.clean, max_threads=2)
+        # Pages are prepared (decoded, resized, analyzed) by worker threads:
+        # results go in self.pages (or self.page_errors), protected by
+        # self.pages_condition.
+        self.prepare_thread = WorkerThread(self.prepare_page_order, name='prepare',
+                                           max_threads=prepare_threads,
+                                           unique_orders=True)
+        self.pages_condition = threading.Condition()
+        self.pages = {}
+        self.page_errors = {}
+        # Number of preparations in progress, per comic.
+        self.preparing = {}
+        # Orders queued by the last call to queue_pages.
+        self.queued_orders = []
+        # Number of pages to prepare in advance, ahead and behind
+        # the current page (relative to the flipping direction).
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
         self.view_mode = self.VIEW_WIDEN_5_4
         self.zoom_mode = self.ZOOM_OFF
         self.zoom_lock = self.ZOOM_OFF
@@ -92,10 +119,22 @@ class DisplayerApp:
         self.next_comic_id = 0
         self.comics = comics
         self.comix = None
+        # False while the current comic pages are still being listed
+        # (they are in a provisional order, see update_listing).
+        self.comix_listed = True
+        # Incremented when page indices change, to ignore stale
+        # preparation orders.
+        self.pages_generation = 0
+        # True until the user moves away from the first page loaded.
+        self.on_first_page = False
         self.load_comic(0)
 
     def clean(self, mess):
         comic, = mess
+        # Wait for pending preparations using this comic.
+        with self.pages_condition:
+            while comic in self.preparing:
+                self.pages_condition.wait()
         log.debug('closing %s', comic.pretty_name)
         comic.close()
 
@@ -103,29 +142,36 @@ class DisplayerApp:
         comic = self.comix
         if comic is None:
             return
-        self.comix = None
+        self.prepare_thread.cancel_orders()
+        self.queued_orders = []
+        with self.pages_condition:
+            self.comix = None
+            self.pages = {}
+            self.page_errors = {}
         self.cleaner_thread.append_order((comic,))
 
     def load_comic(self, comic_id):
         log.info('loading comic %u', comic_id)
         self.close_comic()
         try:
-            comix = ComicBook(self.comics[comic_id])
+            comix = ComicBook(self.comics[comic_id], lazy_listing=True)
         except Exception, e:
             msg = 'could not load comic %s: %s' % (self.comics[comic_id], e)
             log.debug('%s:\n%s', msg, traceback.format_exc())
             self.add_msg(msg, ttl=5)
             comix = None
         if comix is None:
-            self.comix = BaseComicBook(self.comics[comic_id])
+            comix = BaseComicBook(self.comics[comic_id])
             self.pos = ((0,0,) + self.renderer.scrdim) * 3
             self.state = 'static'
             self.force_redraw = True
-        else:
+        # The last page is only known once listing is complete.
+        self.comix_listed = comix.update_listing(wait=self.flip_to_last) is not None
+        with self.pages_condition:
             self.comix = comix
         self.renderer.page = None
         self.comic_id = comic_id
-        self.pages = {}
+        self.on_first_page = True
         if len(self.comix) > 0:
             if self.flip_to_last:
                 page_id = len(self.comix) - 1
@@ -135,36 +181,54 @@ class DisplayerApp:
         else:
             self.next_page_id = self.page_id = 0
 
-    def prepare_page(self, page_id):
-
-        if page_id in self.pages:
-            view_mode, page, bgcolor, frames = self.pages.get(page_id)
-            if view_mode == self.view_mode:
-                return
-            del self.pages[page_id]
-
-        log.info('preparing page %u', page_id)
-
-        name = self.comix.get_filename(page_id)
-        fil = self.comix.get_file(page_id)
+    def update_listing(self):
+        """ Switch to the final page order once the current comic has been
+        completely listed, remapping page indices. """
+        comix = self.comix
+        if self.comix_listed or comix is None or not comix.is_listing_complete():
+            return
+        # Page indices must not change under running preparations.
+        self.prepare_thread.cancel_orders()
+        self.queued_orders = []
+        with self.pages_condition:
+            while comix in self.preparing:
+                self.pages_condition.wait()
+            mapping = comix.update_listing()
+            self.comix_listed = True
+            self.pages_generation += 1
+            self.pages = dict([(mapping[page_id], page) for page_id, page
+                               in self.pages.iteritems()])
+            self.page_errors = dict([(mapping[page_id], error) for page_id, error
+                                     in self.page_errors.iteritems()])
+        if self.page_id < len(mapping):
+            self.page_id = mapping[self.page_id]
+        if self.next_page_id < len(mapping):
+            self.next_page_id = mapping[self.next_page_id]
+        log.info('comic listed: %u pages', len(comix))
+        if self.on_first_page and 0 != self.page_id:
+            # Not the real first page.
+            self.flip_page(-self.page_id)
+        else:
+            self.cache_pages()
 
-        image = Image.from_file(fil)
-        width, height = image.size
+    def page_size(self, size, view_mode, scrdim):
+        """ Return the size a page of <size> is displayed at. """
+        width, height = size
 
-        screen_width, screen_height = self.renderer.scrdim
+        screen_width, screen_height = scrdim
 
         page_ratio = float(width) / height
         if page_ratio > 1.0:
             width, height = height, width
             screen_width, screen_height = screen_height, screen_width
 
-        if self.VIEW_WIDEN_5_4 == self.view_mode:
+        if self.VIEW_WIDEN_5_4 == view_mode:
             # widen to occupy 5:4 ratio zone on screen
             width_5_4 = (screen_height - 2 * self.border_width) * 5 / 4
             multiplier = 1.0*width_5_4 / width
             width2 = width_5_4
             height2 = int(math.floor(height * multiplier))
-        elif self.VIEW_WIDTH == self.view_mode:
+        elif self.VIEW_WIDTH == view_mode:
             # Match screen size.
             width2 = screen_width
             height2 = int(math.floor(1.0 * height * width2 / width))
@@ -180,23 +244,60 @@ class DisplayerApp:
         # Don't upscale.
         if width2 > width or height2 > height:
             width2, height2 = width, height
-        elif width2 != width or height2 != height:
-            image = image.resize((width2, height2))
 
-        page = pygame.image.fromstring(image.to_rgb(), (width2, height2), "RGB")
+        return width2, height2
+
+    def render_page(self, comix, page_id, view_mode, scrdim, left_to_right,
+                    cancelled=lambda: False):
+        """ Decode, resize and analyze page <page_id> of <comix>, returning
+        a (view_mode, surface, bgcolor, frames) tuple, or None if
+        <cancelled>() returned True. Called from the prepare worker
+        threads. """
 
-        image = image.to_pil()
-        page_bgcolor = self.comix.get_bgcolor(page_id)
-        if page_bgcolor is None:
-            log.info('detecting page %u background color', page_id)
-            page_bgcolor = image_tools.get_most_common_edge_colour(image)
-            self.comix.set_bgcolor(page_id, page_bgcolor)
+        log.info('preparing page %u', page_id)
+
+        fil = comix.get_file(page_id)
+        if cancelled():
+            return None
+
+        # The decoder can downscale (e.g. JPEG DCT scaling), so the final
+        # resize is done on a smaller image.
+        image = Image.from_file(fil, target_size=lambda size:
+                                self.page_size(size, view_mode, scrdim))
+        width2, height2 = self.page_size(image.size, view_mode, scrdim)
+        if (width2, height2) != image.size:
+            image = image.resize((width2, height2))
+
+        # The surface shares the decoded pixels.
+        mode, data, stride = image.to_buffer()
+        assert stride == width2 * len(mode)
+        page = pygame.image.frombuffer(data, (width2, height2), mode)
+
+        page_bgcolor = comix.get_bgcolor(page_id)
+        frames = comix.get_frames(page_id)
+        if page_bgcolor is None or frames is None:
+            if cancelled():
+                return None
+            if page_bgcolor is None:
+                log.info('detecting page %u background color', page_id)
+            if frames is None:
+                log.info('detecting page %u frames', page_id)
+            luminance = None
+            if frames is None:
+                luminance = image.to_luminance()
+            if self.detection_pool is None:
+                detect = frame_detection.detect
+            else:
+                detect = self.detection_pool.detect
+            detected_bgcolor, page_frames = detect(
+                image.to_pil(), bgcolor=page_bgcolor,
+                left_to_right=left_to_right, detect_frames=frames is None,
+                luminance=luminance, scale=self.detect_scale)
+            if page_bgcolor is None:
+                page_bgcolor = detected_bgcolor
+                comix.set_bgcolor(page_id, page_bgcolor)
 
-        frames = self.comix.get_frames(page_id)
         if frames is None:
-            log.info('detecting page %u frames', page_id)
-            self.scroller.setup_image(image, page_bgcolor)
-            page_frames = self.scroller._frames
             frames = []
             for f in page_frames:
                 x = float(f.rect.x) / width2
@@ -204,7 +305,7 @@ class DisplayerApp:
                 w = float(f.rect.w) / width2
                 h = float(f.rect.h) / height2
                 frames.append((x, y, w, h))
-            self.comix.set_frames(page_id, frames)
+            comix.set_frames(page_id, frames)
         else:
             page_frames = []
             for x, y, w, h in frames:
@@ -215,13 +316,90 @@ class DisplayerApp:
                 f = Frame(Rect(x, y, w, h), len(page_frames), None)
                 page_frames.append(f)
 
-        self.pages[page_id] = (self.view_mode, page, page_bgcolor, page_frames)
+        return (view_mode, page, page_bgcolor, page_frames)
+
+    def prepare_page_order(self, order):
+        comix, generation, page_id, view_mode, scrdim, left_to_right = order
+        with self.pages_condition:
+            if comix is not self.comix or generation != self.pages_generation:
+                # Cancelled: comic was closed, or its pages reordered.
+                return
+            if page_id in self.pages and self.pages[page_id][0] == view_mode:
+                # Already done by a previous (cancelled, then queued
+                # again) order.
+                return
+            self.preparing[comix] = self.preparing.get(comix, 0) + 1
+        page, error = None, None
+        try:
+            page = self.render_page(comix, page_id, view_mode, scrdim, left_to_right,
+                                    cancelled=lambda: self.prepare_thread.must_stop(order))
+        except Exception, e:
+            log.error('preparing page %u failed: %s', page_id, e)
+            log.debug('Traceback:\n%s', traceback.format_exc())
+            error = e
+        finally:
+            with self.pages_condition:
+                self.preparing[comix] -= 1
+                if 0 == self.preparing[comix]:
+                    del self.preparing[comix]
+                # Ignore stale results.
+                if comix is self.comix and generation == self.pages_generation \
+                   and view_mode == self.view_mode:
+                    if page is not None:
+                        self.pages[page_id] = page
+                    elif error is not None:
+                        self.page_errors[page_id] = error
+                self.pages_condition.notifyAll()
+
+    def is_page_ready(self, page_id):
+        """ Must be called with self.pages_condition held. """
+        if page_id in self.page_errors:
+            return True
+        if not page_id in self.pages:
+            return False
+        return self.pages[page_id][0] == self.view_mode
+
+    def prefetch_window(self, page_id):
+        """ Return the list of pages to prepare in advance when showing
+        page <page_id>, by order of priority. """
+        step = +1 if self.flip_dir else -1
+        pages = [page_id + step * n for n in range(1, self.prefetch_ahead + 1)]
+        pages.extend([page_id - step * n for n in range(1, self.prefetch_behind + 1)])
+        return [p for p in pages if 0 <= p and p < len(self.comix)]
+
+    def queue_pages(self, page_ids):
+        """ Queue preparation of <page_ids> (by order of priority),
+        replacing previously queued preparations: those still wanted are
+        reprioritized, others are cancelled (even if in progress). """
+        orders = []
+        with self.pages_condition:
+            for page_id in page_ids:
+                if self.is_page_ready(page_id):
+                    continue
+                orders.append((self.comix, self.pages_generation, page_id, self.view_mode,
+                               self.renderer.scrdim, self.left_to_right))
+        wanted = set(orders)
+        stale = [order for order in self.queued_orders if not order in wanted]
+        self.queued_orders = orders
+        self.prepare_thread.cancel_orders(stale)
+        self.prepare_thread.extend_orders(orders, range(len(orders)))
+
+    def prepare_page(self, page_id):
+        with self.pages_condition:
+            ready = self.is_page_ready(page_id)
+        if not ready:
+            self.queue_pages([page_id] + self.prefetch_window(page_id))
+        with self.pages_condition:
+            while not self.is_page_ready(page_id):
+                self.pages_condition.wait()
+            if page_id in self.page_errors:
+                raise self.page_errors.pop(page_id)
+            return self.pages[page_id]
 
     def load_page(self, page_id, frame_number=None):
         log.info('loading page %u%s', page_id,
                  '' if frame_number is None else ' (frame %u)' % frame_number)
-        self.prepare_page(page_id)
-        view_mode, page, bgcolor, frames = self.pages[page_id]
+        view_mode, page, bgcolor, frames = self.prepare_page(page_id)
         self.page_id = page_id
         self.renderer.page = page
         self.renderer.zoom_cache = {}
@@ -377,6 +555,7 @@ class DisplayerApp:
         self.state = "leaving_page"
 
     def flip_page(self, delta, rowwise=False):
+        self.on_first_page = False
         self.zoom_mode = self.zoom_lock
         next_comic_id = self.comic_id
         nci = self.page_id
@@ -386,7 +565,7 @@ class DisplayerApp:
                 return self.flip_comic(-1, rowwise=True)
             nci = 0
         elif nci>=len(self.comix):
-            if 1 == delta:
+            if 1 == delta and self.comix_listed:
                 return self.flip_comic(+1)
             nci = len(self.comix)-1
             if nci < 0:
@@ -457,19 +636,19 @@ class DisplayerApp:
         self.src_pos = self.shifted_page(self.flip_dir)
         self.pos = self.src_pos
 
-    def cache_next_page(self):
-        for page_id in self.pages.keys():
-            if abs(page_id - self.page_id) > 1:
-                del self.pages[page_id]
-        step = +1 if self.flip_dir else -1
-        page_id = self.page_id + step
-        if 0 <= page_id and page_id < len(self.comix):
-            self.prepare_page(page_id)
-        log.info('page cache: %s', [page_id for page_id in self.pages])
-        assert len(self.pages) <= 3
+    def cache_pages(self):
+        window = self.prefetch_window(self.page_id)
+        keep = set([self.page_id] + window)
+        with self.pages_condition:
+            for pages in (self.pages, self.page_errors):
+                for page_id in pages.keys():
+                    if not page_id in keep:
+                        del pages[page_id]
+            log.info('page cache: %s', sorted(self.pages))
+        self.queue_pages(window)
 
     def end_changing_page(self):
-        pygame.event.post(pygame.event.Event(self.CACHE_NEXT_PAGE))
+        pygame.event.post(pygame.event.Event(self.CACHE_PAGES))
 
     def add_msg(self, text, ttl=1.5):
         color = pygame.color.Color(*self.renderer.bg)
@@ -593,8 +772,8 @@ class DisplayerApp:
         elif action == 'show_cursor':
             pygame.mouse.set_visible(True)
             pygame.time.set_timer(self.CURSOR_HIDE, 2000)
-        elif action == 'cache_next_page':
-            self.cache_next_page()
+        elif action == 'cache_pages':
+            self.cache_pages()
         elif action == 'toggle_zoom':
             if self.zoom_mode == self.ZOOM_OFF:
                 self.zoom_out()
@@ -656,8 +835,8 @@ class DisplayerApp:
             action = 'show_cursor'
         elif event.type == pyg.VIDEOEXPOSE:
             action = 'redraw'
-        elif event.type == self.CACHE_NEXT_PAGE:
-            action = 'cache_next_page'
+        elif event.type == self.CACHE_PAGES:
+            action = 'cache_pages'
         elif event.type == pyg.KEYDOWN:
             input = pygame.key.name(event.key)
             if event.mod & pyg.KMOD_SHIFT:
@@ -719,6 +898,7 @@ class DisplayerApp:
         self.force_redraw = False
         for event in events:
             self.process_event(event)
+        self.update_listing()
         self.update_screen(msec)
 
     def run(self):
@@ -727,7 +907,10 @@ class DisplayerApp:
                 self.loop(pygame.event.get())
         finally:
             self.close_comic()
+            self.prepare_thread.stop()
             self.cleaner_thread.stop(finish=True)
+            if self.detection_pool is not None:
+                self.detection_pool.close()
             pygame.quit()
 
 if __name__=="__main__":
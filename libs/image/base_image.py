@@ -11,6 +11,18 @@ class BaseImage():
     def to_rgb(self):
         pass
 
+    def to_buffer(self):
+        """ Return a (mode, data, stride) tuple: the pixels in <data>, an
+        object supporting the buffer protocol, in <mode> 'RGB' or 'RGBX'
+        (one padding byte), with rows of <stride> bytes. Backends avoid
+        copying the pixels when possible, so <data> must not be modified. """
+        return 'RGB', self.to_rgb(), self.size[0] * 3
+
+    def to_luminance(self):
+        """ Return a (data, stride) tuple: the luminance plane, one byte
+        per pixel, like to_buffer. """
+        return self.to_pil().convert('L').tostring(), self.size[0]
+
     def crop(self, box, fast=False):
         pass
 
@@ -22,7 +34,8 @@ class BaseImage():
 
     def to_pil(self):
         from libs.image.pil import PILImage
-        return PILImage.from_rgb(self.to_rgb(), self.size)._image
+        mode, data, stride = self.to_buffer()
+        return PILImage.from_buffer(mode, self.size, data, stride)._image
 
     @classmethod
     def open(self, filename):
@@ -32,11 +45,15 @@ class BaseImage():
     def from_rgb(self, string, size):
         pass
 
+    # Optional <target_size> is a function returning the size the image
+    # will be resized to from its original size: decoders supporting it
+    # then produce a smaller image (but not smaller than that), faster.
+
     @classmethod
-    def from_string(self, string):
+    def from_string(self, string, target_size=None):
         pass
 
     @classmethod
-    def from_file(self, file):
-        return self.from_string(file.read())
+    def from_file(self, file, target_size=None):
+        return self.from_string(file.read(), target_size=target_size)
 
@@ -14,6 +14,9 @@ class GraphicsMagicImage(BaseImage):
 
     def __init__(self, image):
         self._image = image
+        # Pixels returned by to_buffer: images are not modified in
+        # place, so they're only exported once.
+        self._buffer = None
 
     def __del__(self):
         gm_wrap.DestroyImage(self._image)
@@ -28,6 +31,27 @@ class GraphicsMagicImage(BaseImage):
         gm_wrap.DispatchImage(self._image, 0, 0, width, height, 'RGB', gm_wrap.CharPixel, buffer, _exception)
         return buffer.raw
 
+    def to_buffer(self):
+        width, height = self.size
+        if self._buffer is None:
+            # Pygame and PIL can use a bytearray without copying it: let
+            # GraphicsMagick write directly to it. Alpha is exported to
+            # the padding byte (4 bytes per pixel can be mapped by PIL).
+            data = bytearray(width * height * 4)
+            pixels = (ctypes.c_char * len(data)).from_buffer(data)
+            gm_wrap.DispatchImage(self._image, 0, 0, width, height, 'RGBA', gm_wrap.CharPixel, pixels, _exception)
+            del pixels
+            self._buffer = data
+        return 'RGBX', self._buffer, width * 4
+
+    def to_luminance(self):
+        width, height = self.size
+        data = bytearray(width * height)
+        pixels = (ctypes.c_char * len(data)).from_buffer(data)
+        gm_wrap.DispatchImage(self._image, 0, 0, width, height, 'I', gm_wrap.CharPixel, pixels, _exception)
+        del pixels
+        return data, width
+
     def resize(self, size, fast=False):
         if fast:
             filter = gm_wrap.CubicFilter
@@ -50,9 +74,31 @@ class GraphicsMagicImage(BaseImage):
         return image
 
     @classmethod
-    def from_string(self, string):
+    def _ping_size(self, image_info, string):
+        """ Return the size of the image in <string>, without decoding it. """
+        image = gm_wrap.PingBlob(image_info, string, len(string), _exception)
+        if not image:
+            return None
+        size = (image.contents.columns, image.contents.rows)
+        gm_wrap.DestroyImage(image)
+        return size
+
+    @classmethod
+    def from_string(self, string, target_size=None):
         image_info = gm_wrap.CloneImageInfo(None)
-        image = GraphicsMagicImage(gm_wrap.BlobToImage(image_info, string, len(string), _exception))
-        gm_wrap.DestroyImageInfo(image_info)
+        try:
+            if target_size is not None:
+                size = self._ping_size(image_info, string)
+                if size is not None:
+                    width, height = target_size(size)
+                    if 0 < width < size[0] and 0 < height < size[1]:
+                        # Decoders supporting it (JPEG) produce an
+                        # image of at least that size.
+                        image_info.contents.size = gm_wrap.String('%ux%u' % (width, height))
+            image = GraphicsMagicImage(gm_wrap.BlobToImage(image_info, string, len(string), _exception))
+        finally:
+            # Not allocated by GraphicsMagick: must not be freed by it.
+            image_info.contents.size = gm_wrap.String(None)
+            gm_wrap.DestroyImageInfo(image_info)
         return image
 
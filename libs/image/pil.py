@@ -20,6 +20,18 @@ class PILImage(BaseImage):
             image = image.convert('RGB')
         return image.tostring()
 
+    def to_buffer(self):
+        image = self._image
+        if not image.mode in ('RGB', 'RGBX'):
+            image = image.convert('RGB')
+        return image.mode, image.tostring(), image.size[0] * len(image.mode)
+
+    def to_luminance(self):
+        image = self._image
+        if 'L' != image.mode:
+            image = image.convert('L')
+        return image.tostring(), image.size[0]
+
     def crop(self, box, fast=False):
         return PILImage(self._image.crop(box))
 
@@ -37,18 +49,30 @@ class PILImage(BaseImage):
         return self._image
 
     @classmethod
-    def open(self, filename):
-        return PILImage(Image.open(filename))
+    def open(self, filename, target_size=None):
+        image = Image.open(filename)
+        if target_size is not None:
+            width, height = target_size(image.size)
+            if 0 < width < image.size[0] and 0 < height < image.size[1]:
+                # Only the header has been read: configure the decoder
+                # to downscale (by 1/2, 1/4 or 1/8 for JPEG).
+                image.draft(image.mode, (width, height))
+        return PILImage(image)
 
     @classmethod
     def from_rgb(self, string, size):
         return PILImage(Image.frombuffer('RGB', size, string, 'raw', 'RGB', 0, 1))
 
     @classmethod
-    def from_string(self, string):
-        return PILImage.open(BytesIO(string))
+    def from_buffer(self, mode, size, data, stride=0):
+        # Shares <data> for 'RGBX', copies it for 'RGB'.
+        return PILImage(Image.frombuffer(mode, size, data, 'raw', mode, stride, 1))
+
+    @classmethod
+    def from_string(self, string, target_size=None):
+        return PILImage.open(BytesIO(string), target_size=target_size)
 
     @classmethod
-    def from_file(self, file):
-        return PILImage.open(file)
+    def from_file(self, file, target_size=None):
+        return PILImage.open(file, target_size=target_size)
 
@@ -0,0 +1,225 @@
+""" Persistent cache of detected page background colors and frames, and
+of archives table of contents. """
+
+import os
+import re
+import json
+import time
+import atexit
+import threading
+
+from mcomix import log
+from mcomix import tools
+
+try:
+    import sqlite3
+except ImportError:
+    log.warning('sqlite3 not available! page cache disabled')
+    sqlite3 = None
+
+PAGE_CACHE_FILENAME = 'page_cache.sqlite'
+
+# Changes are committed at most every COMMIT_DELAY seconds (and when
+# closing the cache).
+COMMIT_DELAY = 5.0
+
+# Comics not opened for MAX_AGE seconds are purged from the cache, as are
+# the least recently opened ones past MAX_COMICS.
+MAX_AGE = 90 * 24 * 60 * 60
+MAX_COMICS = 5000
+
+class PageCache(object):
+
+    def __init__(self, path):
+        """Open (and create if needed) the cache database at <path>."""
+        self._lock = threading.Lock()
+        self._commit_timer = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         ' comic TEXT, size INTEGER, mtime REAL, name TEXT,'
+                         ' bgcolor TEXT, frames TEXT,'
+                         ' PRIMARY KEY (comic, size, mtime, name))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS archives ('
+                         ' comic TEXT, size INTEGER, mtime REAL,'
+                         ' type INTEGER, state BLOB,'
+                         ' PRIMARY KEY (comic, size, mtime))')
+        # When each comic was last opened, for purging.
+        self._db.execute('CREATE TABLE IF NOT EXISTS comics ('
+                         ' comic TEXT, size INTEGER, mtime REAL, used REAL,'
+                         ' PRIMARY KEY (comic, size, mtime))')
+        self._purge()
+        self._db.commit()
+
+    def _purge(self):
+        self._db.execute('DELETE FROM comics WHERE used < ?',
+                         (time.time() - MAX_AGE,))
+        self._db.execute('DELETE FROM comics WHERE rowid NOT IN'
+                         ' (SELECT rowid FROM comics ORDER BY used DESC LIMIT ?)',
+                         (MAX_COMICS,))
+        for table in ('pages', 'archives'):
+            self._db.execute('DELETE FROM %s WHERE NOT EXISTS'
+                             ' (SELECT 1 FROM comics WHERE comics.comic=%s.comic'
+                             ' AND comics.size=%s.size AND comics.mtime=%s.mtime)'
+                             % ((table,) * 4))
+
+    def _changed(self):
+        """Schedule a commit of the changes. Must be called with the
+        lock held."""
+        if self._commit_timer is not None:
+            return
+        self._commit_timer = threading.Timer(COMMIT_DELAY, self.commit)
+        self._commit_timer.setDaemon(True)
+        self._commit_timer.start()
+
+    def commit(self):
+        """Commit pending changes."""
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self._db is not None:
+                self._db.commit()
+
+    def touch(self, comic_key):
+        """Mark the comic identified by <comic_key> as used, so its
+        entries are not purged."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO comics (comic, size, mtime, used)'
+                             ' VALUES (?, ?, ?, ?)', comic_key + (time.time(),))
+            self._changed()
+
+    def get(self, comic_key, name):
+        """Return a (bgcolor, frames) tuple for page <name> of the comic
+        identified by <comic_key>, each being None if unknown."""
+        with self._lock:
+            row = self._db.execute('SELECT bgcolor, frames FROM pages'
+                                   ' WHERE comic=? AND size=? AND mtime=? AND name=?',
+                                   comic_key + (name,)).fetchone()
+        if row is None:
+            return None, None
+        bgcolor, frames = row
+        if bgcolor is not None:
+            bgcolor = parse_color(bgcolor)
+        if frames is not None:
+            frames = [tuple(f) for f in json.loads(frames)]
+        return bgcolor, frames
+
+    def _set(self, comic_key, name, column, value):
+        key = comic_key + (name,)
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO pages (comic, size, mtime, name)'
+                             ' VALUES (?, ?, ?, ?)', key)
+            self._db.execute('UPDATE pages SET %s=?'
+                             ' WHERE comic=? AND size=? AND mtime=? AND name=?' % column,
+                             (value,) + key)
+            self._changed()
+
+    def set_bgcolor(self, comic_key, name, bgcolor):
+        self._set(comic_key, name, 'bgcolor', '#%02x%02x%02x' % tuple(bgcolor[0:3]))
+
+    def set_frames(self, comic_key, name, frames):
+        self._set(comic_key, name, 'frames', json.dumps([list(f) for f in frames]))
+
+    def get_toc(self, comic_key):
+        """Return a (type, state) tuple for the archive identified by
+        <comic_key>: its type as detected by archive_mime_type, and its
+        listing state (see BaseArchive.get_listing_state), or None if
+        unknown."""
+        with self._lock:
+            row = self._db.execute('SELECT type, state FROM archives'
+                                   ' WHERE comic=? AND size=? AND mtime=?',
+                                   comic_key).fetchone()
+        if row is None:
+            return None
+        archive_type, state = row
+        try:
+            state = json.loads(str(state), object_hook=_decode_bytes)
+        except Exception, e:
+            log.warning('invalid cached archive state: %s', e)
+            return None
+        return archive_type, state
+
+    def set_toc(self, comic_key, archive_type, state):
+        try:
+            state = json.dumps(_encode_bytes(state))
+        except Exception, e:
+            log.warning('could not cache archive state: %s', e)
+            return
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO archives (comic, size, mtime, type, state)'
+                             ' VALUES (?, ?, ?, ?, ?)', comic_key + (archive_type, state))
+            self._changed()
+
+    def close(self):
+        # Wait for a running commit, and don't leave the timer thread
+        # behind when exiting.
+        with self._lock:
+            timer = self._commit_timer
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+        self.commit()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+def _encode_bytes(obj):
+    """Return a copy of <obj> that can be serialized to JSON: byte strings
+    (e.g. archive member names, in any encoding) are converted to
+    {'__bytes__': base64} objects, and tuples to lists."""
+    if isinstance(obj, str):
+        return { '__bytes__' : obj.encode('base64') }
+    if isinstance(obj, (list, tuple)):
+        return [_encode_bytes(o) for o in obj]
+    if isinstance(obj, dict):
+        # Keys must already be Unicode (or ASCII) strings.
+        return dict([(k, _encode_bytes(v)) for k, v in obj.iteritems()])
+    return obj
+
+def _decode_bytes(obj):
+    """JSON object hook, reverse of _encode_bytes."""
+    if 1 == len(obj) and '__bytes__' in obj:
+        return obj['__bytes__'].decode('base64')
+    return obj
+
+def parse_color(color):
+    """Parse a '#rrggbb' color, return an (r, g, b) tuple or None if invalid."""
+    if not re.match('^#[0-9a-fA-F]{6}$', color):
+        return None
+    return (int(color[1:3], 16),
+            int(color[3:5], 16),
+            int(color[5:7], 16))
+
+def comic_key(path):
+    """Return the key identifying the comic at <path> in the cache, or None
+    if it can't be accessed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), st.st_size, st.st_mtime)
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """Return the shared page cache, or None if not available."""
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = False
+            if sqlite3 is not None:
+                directory = tools.get_config_directory()
+                try:
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    _page_cache = PageCache(os.path.join(directory, PAGE_CACHE_FILENAME))
+                except Exception, e:
+                    log.warning('could not open page cache: %s', e)
+                else:
+                    # Commit pending changes.
+                    atexit.register(_page_cache.close)
+        return _page_cache or None
+
+# vim: expandtab:sw=4:ts=4
@@ -5,6 +5,7 @@ extraction and adding new archive formats. """
 
 import os
 import errno
+import tempfile
 from mcomix import portability
 from mcomix import i18n
 from mcomix import process
@@ -18,6 +19,18 @@ class BaseArchive(object):
     """ True if concurrent calls to extract is supported. """
     support_concurrent_extractions = False
 
+    """ If concurrent calls to extract are supported, maximum number of
+    them worth doing, None for no other limit than the number of CPUs. """
+    max_concurrent_extractions = None
+
+    """ True if extracting several files with a single call to
+    iter_extract_to_buffer is cheaper than extracting them one by one. """
+    support_batch_extractions = False
+
+    """ True if files already returned by iter_contents can be extracted
+    (from another thread) before listing is complete. """
+    support_extraction_while_listing = False
+
     def __init__(self, archive):
         assert isinstance(archive, unicode), "File should be an Unicode string."
 
@@ -46,6 +59,24 @@ class BaseArchive(object):
         assert isinstance(filename, unicode) and \
             isinstance(destination_dir, unicode)
 
+    def extract_to_buffer(self, filename):
+        """ Extracts the file specified by <filename> in memory, and returns
+        its contents as a string (or a read-only buffer, e.g. mapping the
+        archive file). Returns None if this archive format does not support
+        extracting to memory, in which case extract() must be used. """
+
+        assert isinstance(filename, unicode)
+
+        return None
+
+    def iter_extract_to_buffer(self, entries):
+        """ Generator to extract <entries> from archive in memory, yielding
+        (filename, data) tuples in no particular order. Like with
+        extract_to_buffer, data is None if the file could not be extracted
+        in memory. """
+        for filename in entries:
+            yield filename, self.extract_to_buffer(filename)
+
     def iter_extract(self, entries, destination_dir):
         """ Generator to extract <entries> from archive to <destination_dir>. """
         wanted = set(entries)
@@ -63,6 +94,20 @@ class BaseArchive(object):
 
         pass
 
+    def get_listing_state(self):
+        """ Returns the state built when listing the archive contents (after
+        list_contents was called), made of lists, dictionaries (with Unicode
+        keys), strings, numbers and booleans (tuples are restored as lists).
+        It can be passed to set_listing_state to skip listing when opening
+        the same archive again. Returns None if not supported by this
+        archive format. """
+        return None
+
+    def set_listing_state(self, state):
+        """ Restores <state> returned by get_listing_state, instead of
+        listing the archive contents. """
+        raise NotImplementedError()
+
     def is_solid(self):
         """ Returns True if the archive is solid and extraction should be done
         in one pass. """
@@ -133,6 +178,12 @@ class NonUnicodeArchive(BaseArchive):
         else:
             return i18n.to_utf8(filename)
 
+    def get_listing_state(self):
+        return { 'unicode_mapping' : dict(self.unicode_mapping) }
+
+    def set_listing_state(self, state):
+        self.unicode_mapping.update(state['unicode_mapping'])
+
 class ExternalExecutableArchive(NonUnicodeArchive):
     """ For archives that are extracted by spawning an external
     application. """
@@ -141,12 +192,46 @@ class ExternalExecutableArchive(NonUnicodeArchive):
     calls are supported. """
     support_concurrent_extractions = True
 
+    """ Extracting several files at once saves spawning a process per
+    file, each having to read the archive headers again. Only enabled by
+    subclasses implementing _get_batch_extract_arguments, and listing the
+    file sizes. """
+    support_batch_extractions = False
+
+    """ Each extraction spawns its own process. """
+    support_extraction_while_listing = True
+
     def __init__(self, archive):
         super(ExternalExecutableArchive, self).__init__(archive)
         # Flag to determine if list_contents() has been called
         # This builds the Unicode mapping and is likely required
         # for extracting filenames that have been internally mapped.
         self.filenames_initialized = False
+        # List of (original filename, size) tuples for files whose
+        # uncompressed size is known from the listing, in archive order.
+        # Filled by subclasses that support it, needed for extracting
+        # several files in one pass.
+        self._contents = []
+
+    def get_listing_state(self):
+        state = super(ExternalExecutableArchive, self).get_listing_state()
+        state['contents'] = list(self._contents)
+        return state
+
+    def set_listing_state(self, state):
+        super(ExternalExecutableArchive, self).set_listing_state(state)
+        self._contents = list(state['contents'])
+        self.filenames_initialized = True
+
+    def _ensure_listed(self, filenames):
+        """ List the archive contents, unless already done or enough
+        for mapping <filenames> back to their original names. """
+        if self.filenames_initialized:
+            return
+        for filename in filenames:
+            if not filename in self.unicode_mapping:
+                self.list_contents()
+                return
 
     def _get_executable(self):
         """ Returns the executable's name or path. Return None if no executable
@@ -163,6 +248,19 @@ class ExternalExecutableArchive(NonUnicodeArchive):
         to extract a file to STDOUT. """
         raise NotImplementedError("Subclasses must override _get_extract_arguments.")
 
+    def _get_batch_extract_arguments(self, filenames, list_file):
+        """ Returns an array of arguments required for the executable to
+        extract <filenames> (as returned by _quote_filename) to STDOUT, in
+        archive order. <list_file> is the path to a file listing them, one
+        per line, for executables supporting it. """
+        raise NotImplementedError("Subclasses supporting batch extractions must override _get_batch_extract_arguments.")
+
+    def _quote_filename(self, filename):
+        """ Returns the original archive name <filename> as it must be
+        passed to the executable, or None if that's not possible (e.g. the
+        executable would take it for a wildcard pattern). """
+        return filename
+
     def _parse_list_output_line(self, line):
         """ Parses the output of the external executable's list command
         and return either a file path relative to the archive's root,
@@ -180,7 +278,9 @@ class ExternalExecutableArchive(NonUnicodeArchive):
         fd = proc.spawn()
 
         try:
-            for line in fd.readlines():
+            # Read the output as it comes, so files can be extracted
+            # before listing is complete.
+            for line in iter(fd.readline, ''):
                 filename = self._parse_list_output_line(line.rstrip(os.linesep))
                 if filename is not None:
                     yield self._unicode_filename(filename)
@@ -190,31 +290,126 @@ class ExternalExecutableArchive(NonUnicodeArchive):
 
         self.filenames_initialized = True
 
-    def extract(self, filename, destination_dir):
-        """ Extract <filename> from the archive to <destination_dir>. """
-        assert isinstance(filename, unicode) and \
-                isinstance(destination_dir, unicode)
+    def extract_to_buffer(self, filename):
+        """ Extract <filename> from the archive to memory. """
+        assert isinstance(filename, unicode)
 
         if not self._get_executable():
-            return
+            return None
 
-        if not self.filenames_initialized:
-            self.list_contents()
+        self._ensure_listed((filename,))
 
+        original_filename = self._original_filename(filename)
+        quoted_filename = self._quote_filename(original_filename)
+        if quoted_filename is None:
+            # Best effort.
+            quoted_filename = original_filename
         proc = process.Process([self._get_executable()] +
             self._get_extract_arguments() +
-            [self.archive, self._original_filename(filename)])
+            [self.archive, quoted_filename])
         fd = proc.spawn()
 
-        if fd:
-            # Create new file
-            new = self._create_file(os.path.join(destination_dir, filename))
-            stdout, stderr = proc.communicate()
-            new.write(stdout)
-            new.close()
+        if not fd:
+            return None
 
-            # Wait for process to finish
-            fd.close()
-            proc.wait()
+        stdout, stderr = proc.communicate()
+
+        # Wait for process to finish
+        fd.close()
+        proc.wait()
+
+        return stdout
+
+    def iter_extract_to_buffer(self, entries):
+        """ Extract <entries> to memory, spawning a single process for all
+        the files whose size is known: the output is split using the sizes
+        from the listing. Others are extracted one by one. """
+        if not self._get_executable():
+            for f in super(ExternalExecutableArchive, self).iter_extract_to_buffer(entries):
+                yield f
+            return
+
+        entries = list(entries)
+        self._ensure_listed(entries)
+
+        if self.support_batch_extractions:
+            sized = set([filename for filename, size in self._contents])
+        else:
+            sized = set()
+        wanted = {}
+        others = []
+        for unicode_name in entries:
+            filename = self._original_filename(unicode_name)
+            if filename in sized and self._quote_filename(filename) is not None:
+                wanted[filename] = unicode_name
+            else:
+                others.append(unicode_name)
+
+        if len(wanted) > 0:
+            for f in self._iter_batch_extract_to_buffer(wanted):
+                yield f
+            # Fallback for files the batch failed to extract.
+            others.extend(wanted.values())
+
+        for unicode_name in others:
+            yield unicode_name, self.extract_to_buffer(unicode_name)
+
+    def _iter_batch_extract_to_buffer(self, wanted):
+        """ Extract files from the <wanted> dictionary (original filename ->
+        Unicode filename) in a single pass, removing them from <wanted> as
+        they are extracted. """
+        entries = [(filename, size) for filename, size in self._contents
+                   if filename in wanted]
+        filenames = [self._quote_filename(filename) for filename, size in entries]
+        list_file = tempfile.NamedTemporaryFile(prefix='mcomix.list.', delete=False)
+        try:
+            for filename in filenames:
+                if isinstance(filename, unicode):
+                    filename = filename.encode('utf-8')
+                list_file.write(filename + os.linesep)
+            list_file.close()
+
+            proc = process.Process([self._get_executable()] +
+                self._get_batch_extract_arguments(filenames, list_file.name))
+            fd = proc.spawn(stdin=process.NULL)
+            if not fd:
+                return
+
+            extracted = []
+            try:
+                for filename, size in entries:
+                    data = fd.read(size)
+                    if len(data) != size:
+                        return
+                    extracted.append((filename, data))
+                # The output is only split using the listed sizes: if it
+                # does not match exactly (e.g. a missing or extra file),
+                # files are extracted one by one instead.
+                if 0 != len(fd.read(1)):
+                    return
+            finally:
+                # Wait for process to finish
+                fd.close()
+                proc.wait()
+
+        finally:
+            os.unlink(list_file.name)
+
+        for filename, data in extracted:
+            yield wanted.pop(filename), data
+
+    def extract(self, filename, destination_dir):
+        """ Extract <filename> from the archive to <destination_dir>. """
+        assert isinstance(filename, unicode) and \
+                isinstance(destination_dir, unicode)
+
+        data = self.extract_to_buffer(filename)
+        if data is None:
+            return
+
+        # Create new file
+        new = self._create_file(os.path.join(destination_dir, filename))
+        new.write(data)
+        new.close()
 
 # vim: expandtab:sw=4:ts=4
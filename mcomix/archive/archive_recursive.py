@@ -7,6 +7,125 @@ from mcomix import archive_tools
 from mcomix import log
 
 import os
+import threading
+
+# Maximum size of a sub-archive extracted to memory to be opened from
+# there (instead of from a copy on disk).
+MAX_SUB_ARCHIVE_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Maximum total size of sub-archives kept in memory: past it, the least
+# recently used ones are released (and extracted again when needed).
+MAX_SUB_ARCHIVES_BUFFER_SIZE = 128 * 1024 * 1024
+
+class _SubArchive(archive_base.BaseArchive):
+    """ Sub-archive <filename> of <parent> (whose entries are relative to
+    <root>), only opened when first accessed. If opened from memory, it
+    can be released afterward, and opened again on the next access. """
+
+    def __init__(self, recursive_archive, parent, filename, root):
+        super(_SubArchive, self).__init__(os.path.join(parent.archive, filename))
+        self._recursive_archive = recursive_archive
+        self._parent = parent
+        self._filename = filename
+        self._root = root
+        self._archive = None
+        self._lock = threading.Lock()
+        # Listing state of the archive, restored when opening it again.
+        self._state = None
+        self._solid = None
+        self.listed = False
+
+    def _set_capabilities(self, archive):
+        self.support_concurrent_extractions = archive.support_concurrent_extractions
+        self.max_concurrent_extractions = archive.max_concurrent_extractions
+        self.support_batch_extractions = archive.support_batch_extractions
+        self.support_extraction_while_listing = archive.support_extraction_while_listing
+
+    def open(self):
+        """ Returns the opened archive, or None if not supported. """
+        size = 0
+        with self._lock:
+            archive = self._archive
+            if archive is None:
+                archive, size = self._recursive_archive._open_sub_archive(
+                    self._parent, self._filename, self._root)
+                if archive is None:
+                    return None
+                if self._state is not None:
+                    archive.set_listing_state(self._state)
+                self._set_capabilities(archive)
+                self._archive = archive
+        self._recursive_archive._sub_archive_used(self, size)
+        return archive
+
+    def _get_archive(self):
+        archive = self.open()
+        if archive is None:
+            raise ValueError('could not open sub-archive: %s' % self.archive)
+        return archive
+
+    def release(self):
+        """ Release the archive, and the memory used by it. """
+        with self._lock:
+            if self._archive is None:
+                return
+            if self._state is None:
+                self._state = self._archive.get_listing_state()
+            # Not closed: it may still be in use by another thread.
+            self._archive = None
+
+    def iter_contents(self):
+        for f in self._get_archive().iter_contents():
+            yield f
+        self.listed = True
+
+    def extract(self, filename, destination_dir):
+        self._get_archive().extract(filename, destination_dir)
+
+    def extract_to_buffer(self, filename):
+        return self._get_archive().extract_to_buffer(filename)
+
+    def iter_extract_to_buffer(self, entries):
+        return self._get_archive().iter_extract_to_buffer(entries)
+
+    def iter_extract(self, entries, destination_dir):
+        return self._get_archive().iter_extract(entries, destination_dir)
+
+    def is_solid(self):
+        if self._solid is None:
+            self._solid = self._get_archive().is_solid()
+        return self._solid
+
+    def get_listing_state(self):
+        with self._lock:
+            archive = self._archive
+            state = self._state
+        if archive is not None:
+            state = archive.get_listing_state()
+        if state is None:
+            return None
+        return { 'archive' : state,
+                 'solid' : self.is_solid(),
+                 'support_concurrent_extractions' : self.support_concurrent_extractions,
+                 'max_concurrent_extractions' : self.max_concurrent_extractions,
+                 'support_batch_extractions' : self.support_batch_extractions,
+                 'support_extraction_while_listing' : self.support_extraction_while_listing }
+
+    def set_listing_state(self, state):
+        self._state = state['archive']
+        self._solid = state['solid']
+        self.support_concurrent_extractions = state['support_concurrent_extractions']
+        self.max_concurrent_extractions = state['max_concurrent_extractions']
+        self.support_batch_extractions = state['support_batch_extractions']
+        self.support_extraction_while_listing = state['support_extraction_while_listing']
+        self.listed = True
+
+    def close(self):
+        with self._lock:
+            archive = self._archive
+            self._archive = None
+        if archive is not None:
+            archive.close()
 
 class RecursiveArchive(archive_base.BaseArchive):
 
@@ -20,50 +139,141 @@ class RecursiveArchive(archive_base.BaseArchive):
         self._archive_root = {}
         self._contents_listed = False
         self._contents = []
+        # Set once listing is over (even if it failed), for extractions
+        # waiting on it from other threads.
+        self._listing_started = False
+        self._listing_done = threading.Event()
+        # Entries of sub-archives are only extracted while listing if
+        # they support it too, see _get_entry.
+        self.support_extraction_while_listing = archive.support_extraction_while_listing
         # Assume concurrent extractions are not supported.
         self.support_concurrent_extractions = False
+        self.max_concurrent_extractions = None
+        # Same for batch extractions.
+        self.support_batch_extractions = False
+        # Sub-archives opened from memory, least recently used first,
+        # with the size of their data.
+        self._buffered_archives = []
+        self._buffered_archives_lock = threading.Lock()
 
     def _iter_contents(self, archive, root=None):
         self._archive_list.append(archive)
         self._archive_root[archive] = root
         supported_archive_regexp = archive_tools.get_supported_archive_regex()
+        # Sub-archives are only opened once the archive has been listed,
+        # so its own entries are available first.
+        sub_archives = []
         for f in archive.iter_contents():
             if supported_archive_regexp.search(f):
-                # Extract sub-archive.
-                destination_dir = os.path.join(self._destination_dir, 'sub-archives')
-                if root is not None:
-                    destination_dir = os.path.join(destination_dir, root)
-                archive.extract(f, destination_dir)
-                # And open it and list its contents.
-                sub_archive_path = os.path.join(destination_dir, f)
-                # Ignore directories!
-                if os.path.isdir(sub_archive_path):
-                    continue
-                sub_archive = archive_tools.get_archive_handler(sub_archive_path)
-                if sub_archive is None:
-                    log.warning('Non-supported archive format: %s' %
-                                os.path.basename(sub_archive_path))
-                    continue
-                sub_root = f
-                if root is not None:
-                    sub_root = os.path.join(root, sub_root)
-                for name in self._iter_contents(sub_archive, sub_root):
-                    yield name
+                sub_archives.append(f)
             else:
                 name = f
                 if root is not None:
                     name = os.path.join(root, name)
                 self._entry_mapping[name] = (archive, f)
                 yield name
+        for f in sub_archives:
+            sub_archive = _SubArchive(self, archive, f, root)
+            if sub_archive.open() is None:
+                continue
+            sub_root = f
+            if root is not None:
+                sub_root = os.path.join(root, sub_root)
+            for name in self._iter_contents(sub_archive, sub_root):
+                yield name
+
+    def _open_sub_archive(self, archive, filename, root):
+        """ Open sub-archive <filename> of <archive>: directly from memory
+        if possible, else from a copy extracted to disk. Returns a tuple
+        (sub_archive, size) with the size of the memory used by it, and
+        None for sub_archive if not supported. """
+        data = archive.extract_to_buffer(filename)
+        if data is not None:
+            if 0 == len(data):
+                # Directory, or empty file.
+                return None, 0
+            # Mapped data does not use memory, only keep
+            # small enough extracted copies.
+            mapped = isinstance(data, buffer)
+            if mapped or len(data) <= MAX_SUB_ARCHIVE_BUFFER_SIZE:
+                name = os.path.join(archive.archive, filename)
+                sub_archive = archive_tools.get_buffer_archive_handler(name, data)
+                if sub_archive is not None:
+                    if mapped:
+                        return sub_archive, 0
+                    return sub_archive, len(data)
+        # Extract sub-archive.
+        destination_dir = os.path.join(self._destination_dir, 'sub-archives')
+        if root is not None:
+            destination_dir = os.path.join(destination_dir, root)
+        sub_archive_path = os.path.join(destination_dir, filename)
+        if data is None:
+            archive.extract(filename, destination_dir)
+        else:
+            # No need to extract it again.
+            with self._create_file(sub_archive_path) as fp:
+                fp.write(data)
+            del data
+        # Ignore directories!
+        if os.path.isdir(sub_archive_path):
+            return None, 0
+        sub_archive = archive_tools.get_archive_handler(sub_archive_path)
+        if sub_archive is None:
+            log.warning('Non-supported archive format: %s' %
+                        os.path.basename(sub_archive_path))
+        return sub_archive, 0
+
+    def _sub_archive_used(self, sub_archive, size):
+        """ Update the usage of sub-archives opened from memory, <size>
+        being non-zero if <sub_archive> was just opened, and release the
+        least recently used ones when over MAX_SUB_ARCHIVES_BUFFER_SIZE. """
+        released = []
+        with self._buffered_archives_lock:
+            buffered = self._buffered_archives
+            for n, (archive, archive_size) in enumerate(buffered):
+                if archive == sub_archive:
+                    size = archive_size
+                    del buffered[n]
+                    break
+            if 0 == size:
+                return
+            buffered.append((sub_archive, size))
+            total_size = sum([archive_size for archive, archive_size in buffered])
+            # Archives still being listed are kept.
+            for archive, archive_size in list(buffered[:-1]):
+                if total_size <= MAX_SUB_ARCHIVES_BUFFER_SIZE:
+                    break
+                if not archive.listed:
+                    continue
+                buffered.remove((archive, archive_size))
+                released.append(archive)
+                total_size -= archive_size
+        for archive in released:
+            archive.release()
 
     def _check_concurrent_extraction_support(self):
         supported = True
+        max_extractions = None
         # We need all archives to support concurrent extractions.
         for archive in self._archive_list:
             if not archive.support_concurrent_extractions:
                 supported = False
                 break
+            if archive.max_concurrent_extractions is not None:
+                max_extractions = min(archive.max_concurrent_extractions,
+                                      max_extractions or archive.max_concurrent_extractions)
         self.support_concurrent_extractions = supported
+        self.max_concurrent_extractions = max_extractions
+
+    def _check_batch_extraction_support(self):
+        # Batches are split per archive, so one archive supporting
+        # them is enough.
+        supported = False
+        for archive in self._archive_list:
+            if archive.support_batch_extractions:
+                supported = True
+                break
+        self.support_batch_extractions = supported
 
     def iter_contents(self):
         if self._contents_listed:
@@ -71,27 +281,64 @@ class RecursiveArchive(archive_base.BaseArchive):
                 yield f
             return
         self._contents = []
-        for f in self._iter_contents(self._main_archive):
-            self._contents.append(f)
-            yield f
-        self._contents_listed = True
+        self._listing_started = True
+        try:
+            for f in self._iter_contents(self._main_archive):
+                self._contents.append(f)
+                yield f
+            self._contents_listed = True
+        finally:
+            self._listing_done.set()
         # We can now check if concurrent extractions are really supported.
         self._check_concurrent_extraction_support()
+        self._check_batch_extraction_support()
 
     def list_contents(self):
         if self._contents_listed:
             return self._contents
         return [f for f in self.iter_contents()]
 
-    def extract(self, filename, destination_dir):
+    def _get_entry(self, filename):
+        """ Returns the (archive, name) tuple for <filename>. If the contents
+        are being listed by another thread, only waits for it to be done
+        if that archive does not support extracting while listing. """
         if not self._contents_listed:
-            self.list_contents()
-        archive, name = self._entry_mapping[filename]
+            entry = self._entry_mapping.get(filename)
+            if entry is not None and entry[0].support_extraction_while_listing:
+                return entry
+            if self._listing_started:
+                self._listing_done.wait()
+            else:
+                self.list_contents()
+        return self._entry_mapping[filename]
+
+    def extract(self, filename, destination_dir):
+        archive, name = self._get_entry(filename)
         root = self._archive_root[archive]
         if root is not None:
             destination_dir = os.path.join(destination_dir, root)
         archive.extract(name, destination_dir)
 
+    def extract_to_buffer(self, filename):
+        archive, name = self._get_entry(filename)
+        return archive.extract_to_buffer(name)
+
+    def iter_extract_to_buffer(self, entries):
+        wanted = dict([(f, self._get_entry(f)) for f in entries])
+        # The list may still grow if listing is in progress.
+        for archive in list(self._archive_list):
+            # Map archive names to our names.
+            archive_wanted = dict([(name, f) for f, (a, name) in wanted.iteritems()
+                                   if archive == a])
+            if 0 == len(archive_wanted):
+                continue
+            for name, data in archive.iter_extract_to_buffer(archive_wanted.keys()):
+                yield archive_wanted[name], data
+            for f in archive_wanted.itervalues():
+                del wanted[f]
+            if 0 == len(wanted):
+                break
+
     def iter_extract(self, entries, destination_dir):
         if not self._contents_listed:
             self.list_contents()
@@ -100,16 +347,18 @@ class RecursiveArchive(archive_base.BaseArchive):
         # we need to call iter_extract (not extract) for each archive ourselves.
         wanted = set(entries)
         for archive in self._archive_list:
-            archive_wanted = filter(lambda f: archive == self._entry_mapping[f][0], wanted)
+            # Map archive names to our names.
+            archive_wanted = dict([(self._entry_mapping[f][1], f) for f in wanted
+                                   if archive == self._entry_mapping[f][0]])
             if 0 == len(archive_wanted):
                 continue
             root = self._archive_root[archive]
             archive_destination_dir = destination_dir
             if root is not None:
                 archive_destination_dir = os.path.join(destination_dir, root)
-            for f in archive.iter_extract(list(archive_wanted), archive_destination_dir):
-                yield f
-            wanted -= set(archive_wanted)
+            for name in archive.iter_extract(archive_wanted.keys(), archive_destination_dir):
+                yield archive_wanted[name]
+            wanted -= set(archive_wanted.values())
             if 0 == len(wanted):
                 break
 
@@ -122,6 +371,50 @@ class RecursiveArchive(archive_base.BaseArchive):
                 return True
         return False
 
+    def get_listing_state(self):
+        if not self._contents_listed:
+            self.list_contents()
+        state = self._main_archive.get_listing_state()
+        if state is None:
+            return None
+        index = dict([(archive, n) for n, archive in enumerate(self._archive_list)])
+        sub_archives = []
+        for archive in self._archive_list[1:]:
+            sub_state = archive.get_listing_state()
+            if sub_state is None:
+                return None
+            sub_archives.append({ 'parent' : index[archive._parent],
+                                  'filename' : archive._filename,
+                                  'state' : sub_state })
+        entries = []
+        for f in self._contents:
+            archive, name = self._entry_mapping[f]
+            entries.append((index[archive], name))
+        return { 'contents' : list(self._contents), 'entries' : entries,
+                 'archive' : state, 'sub_archives' : sub_archives }
+
+    def set_listing_state(self, state):
+        self._main_archive.set_listing_state(state['archive'])
+        self._archive_list = [self._main_archive]
+        self._archive_root = { self._main_archive : None }
+        # Sub-archives are only opened when first accessed.
+        for sub_state in state['sub_archives']:
+            parent = self._archive_list[sub_state['parent']]
+            root = self._archive_root[parent]
+            sub_archive = _SubArchive(self, parent, sub_state['filename'], root)
+            sub_archive.set_listing_state(sub_state['state'])
+            sub_root = sub_state['filename']
+            if root is not None:
+                sub_root = os.path.join(root, sub_root)
+            self._archive_list.append(sub_archive)
+            self._archive_root[sub_archive] = sub_root
+        self._contents = list(state['contents'])
+        self._entry_mapping = dict([(f, (self._archive_list[n], name))
+                                    for f, (n, name) in zip(self._contents, state['entries'])])
+        self._contents_listed = True
+        self._check_concurrent_extraction_support()
+        self._check_batch_extraction_support()
+
     def close(self):
         for archive in self._archive_list:
             archive.close()
@@ -16,6 +16,9 @@ PDF_RENDER_DPI_DEF = 72 * 4
 PDF_RENDER_DPI_MAX = 72 * 10
 
 _pdf_possible = None
+# As found by is_available.
+_mudraw_executable = u'mudraw'
+_mutool_executable = u'mutool'
 
 class PdfArchive(archive_base.BaseArchive):
 
@@ -29,7 +32,7 @@ class PdfArchive(archive_base.BaseArchive):
         self.pdf = archive
 
     def iter_contents(self):
-        proc = process.Process(['mutool', 'show', '--', self.pdf, 'pages'])
+        proc = process.Process([_mutool_executable, 'show', '--', self.pdf, 'pages'])
         fd = proc.spawn()
         if fd is None:
             return
@@ -46,7 +49,7 @@ class PdfArchive(archive_base.BaseArchive):
         destination_path = os.path.join(destination_dir, filename)
         page_num = int(filename[0:-4])
         # Try to find optimal DPI.
-        proc = process.Process(['mudraw', '-x', '--', self.pdf, str(page_num)])
+        proc = process.Process([_mudraw_executable, '-x', '--', self.pdf, str(page_num)])
         fd = proc.spawn()
         max_size = 0
         max_dpi = PDF_RENDER_DPI_DEF
@@ -71,7 +74,7 @@ class PdfArchive(archive_base.BaseArchive):
             fd.close()
             proc.wait()
         # Render...
-        cmd = ['mudraw', '-r', str(max_dpi), '-o', destination_path, '--', self.pdf, str(page_num)]
+        cmd = [_mudraw_executable, '-r', str(max_dpi), '-o', destination_path, '--', self.pdf, str(page_num)]
         log.debug('rendering %s: %s' % (filename, ' '.join(cmd)))
         proc = process.Process(cmd)
         fd = proc.spawn()
@@ -79,18 +82,24 @@ class PdfArchive(archive_base.BaseArchive):
             fd.close()
             proc.wait()
 
+    def get_listing_state(self):
+        # Pages are extracted by number, no state needed.
+        return {}
+
+    def set_listing_state(self, state):
+        pass
+
     def close(self):
         self.pdf = None
 
     @staticmethod
     def is_available():
-        global _pdf_possible
+        global _pdf_possible, _mudraw_executable, _mutool_executable
         if _pdf_possible is None:
-            proc = process.Process(['mudraw'])
-            fd = proc.spawn()
-            if fd is not None:
-                fd.close()
-                proc.wait()
+            executable = process.find_executable((u'mudraw',))
+            if executable is not None:
+                _mudraw_executable = executable
+                _mutool_executable = process.find_executable((u'mutool',)) or _mutool_executable
                 _pdf_possible = True
             else:
                 log.info('MuPDF not available.')
@@ -2,43 +2,114 @@
 
 """ RAR archive extractor. """
 
+import re
+
 from mcomix import process
 from mcomix.archive import archive_base
 
 # Filled on-demand by RarExecArchive
 _rar_executable = -1
+# Major version of _rar_executable, None if unknown.
+_rar_version = None
 
 class RarExecArchive(archive_base.ExternalExecutableArchive):
     """ RAR file extractor using the unrar/rar executable. """
 
+    support_batch_extractions = True
+
+    def __init__(self, archive):
+        super(RarExecArchive, self).__init__(archive)
+        self._path = None
+        self._is_file = None
+
     def _get_executable(self):
         return RarExecArchive._find_unrar_executable()
 
+    def _is_bare_listing(self):
+        """ The technical listing of unrar 4.x and older has a different
+        format: only list bare names then (without sizes, so no batch
+        extractions). """
+        self._get_executable()
+        return _rar_version is not None and _rar_version < 5
+
     def _get_list_arguments(self):
-        return [u'vb', u'-p-', u'--']
+        if self._is_bare_listing():
+            return [u'vb', u'-p-', u'--']
+        return [u'lt', u'-p-', u'--']
 
     def _get_extract_arguments(self):
         return [u'p', u'-inul', u'-p-', u'--']
 
+    def _get_batch_extract_arguments(self, filenames, list_file):
+        return self._get_extract_arguments() + [self.archive, u'@' + list_file]
+
+    def _quote_filename(self, filename):
+        # Names are wildcard patterns, with no way to escape them.
+        if '*' in filename or '?' in filename:
+            return None
+        return filename
+
+    def _parse_list_output_line(self, line):
+        """ Parses the technical listing: each entry is a block of
+        'Key: value' lines, starting with the name. Only files are
+        returned (entries without a type too), with their size stored
+        for batch extractions. """
+        if self._is_bare_listing():
+            return line
+        match = re.match(r'^\s*(Name|Type|Size): (.*)$', line)
+        if match is None:
+            return None
+        key, value = match.groups()
+        if 'Name' == key:
+            self._path = value
+            self._is_file = None
+        elif self._path is None:
+            pass
+        elif 'Type' == key:
+            self._is_file = 'File' == value
+            if not self._is_file:
+                self._path = None
+            else:
+                return self._path
+        elif 'Size' == key:
+            path = self._path
+            self._contents.append((path, int(value)))
+            self._path = None
+            if self._is_file is None:
+                return path
+        return None
+
     @staticmethod
     def _find_unrar_executable():
-        """ Tries to start rar/unrar, and returns either 'rar' or 'unrar' if
-        one of them was started successfully.
-        Returns None if neither could be started. """
-        global _rar_executable
+        """ Returns 'unrar' or 'rar', whichever is found first on the
+        system PATH, or None if neither is. """
+        global _rar_executable, _rar_version
         if _rar_executable != -1:
             return _rar_executable
         else:
-            for command in (u'unrar', u'rar'):
-                proc = process.Process([command])
-                fd = proc.spawn()
-                if fd is not None:
-                    fd.close()
-                    _rar_executable = command
-                    return command
-
-            _rar_executable = None
+            _rar_executable = process.find_executable((u'unrar', u'rar'))
+            if _rar_executable is not None:
+                _rar_version = RarExecArchive._get_unrar_version(_rar_executable)
+            return _rar_executable
+
+    @staticmethod
+    def _get_unrar_version(executable):
+        """ Returns the major version of <executable>, from the banner it
+        prints when started without arguments, or None if unknown. """
+        proc = process.Process([executable])
+        fd = proc.spawn()
+        if fd is None:
             return None
+        version = None
+        try:
+            for line in fd:
+                match = re.match(r'^\s*(?:UN)?RAR\s+(\d+)\.', line)
+                if match is not None and version is None:
+                    version = int(match.group(1))
+        finally:
+            fd.close()
+            proc.wait()
+        return version
 
     @staticmethod
     def is_available():
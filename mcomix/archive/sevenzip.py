@@ -17,13 +17,14 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
 
     STATE_HEADER, STATE_LISTING, STATE_FOOTER = 1, 2, 3
 
+    support_batch_extractions = True
+
     def __init__(self, archive):
         super(SevenZipArchive, self).__init__(archive)
 
         self._is_solid = False
         #: Indicates which part of the file listing has been read
         self._state = SevenZipArchive.STATE_HEADER
-        self._contents = []
         #: Current path while listing contents
         self._path = None
 
@@ -74,16 +75,32 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
     def is_solid(self):
         return self._is_solid
 
-    def extract(self, filename, destination_dir):
-        """ Extract <filename> from the archive to <destination_dir>. """
-        assert isinstance(filename, unicode) and \
-                isinstance(destination_dir, unicode)
+    def get_listing_state(self):
+        state = super(SevenZipArchive, self).get_listing_state()
+        state['solid'] = self._is_solid
+        return state
+
+    def set_listing_state(self, state):
+        super(SevenZipArchive, self).set_listing_state(state)
+        self._is_solid = state['solid']
+
+    def _get_batch_extract_arguments(self, filenames, list_file):
+        return [u'x', u'-so', u'-p', u'-i@' + list_file, u'--', self.archive]
+
+    def _quote_filename(self, filename):
+        # Listed names are wildcard patterns, with no way to escape them.
+        if '*' in filename or '?' in filename:
+            return None
+        return filename
+
+    def extract_to_buffer(self, filename):
+        """ Extract <filename> from the archive to memory. """
+        assert isinstance(filename, unicode)
 
         if not self._get_executable():
-            return
+            return None
 
-        if not self.filenames_initialized:
-            self.list_contents()
+        self._ensure_listed((filename,))
 
         tmplistfile = tempfile.NamedTemporaryFile(prefix='mcomix.7z.', delete=False)
         try:
@@ -99,16 +116,16 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
                                     u'--', self.archive])
             fd = proc.spawn()
 
-            if fd:
-                # Create new file
-                new = self._create_file(os.path.join(destination_dir, filename))
-                stdout, stderr = proc.communicate()
-                new.write(stdout)
-                new.close()
+            if not fd:
+                return None
+
+            stdout, stderr = proc.communicate()
+
+            # Wait for process to finish
+            fd.close()
+            proc.wait()
 
-                # Wait for process to finish
-                fd.close()
-                proc.wait()
+            return stdout
         finally:
             os.unlink(tmplistfile.name)
 
@@ -153,21 +170,14 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
 
     @staticmethod
     def _find_7z_executable():
-        """ Tries to start 7z, and returns either '7z' if
-        it was started successfully or None otherwise. """
+        """ Returns '7z' if found on the system PATH, or None
+        otherwise. """
         global _7z_executable
         if _7z_executable != -1:
             return _7z_executable
         else:
-            proc = process.Process([u'7z'])
-            fd = proc.spawn()
-            if fd is not None:
-                fd.close()
-                _7z_executable = u'7z'
-                return u'7z'
-            else:
-                _7z_executable = None
-                return None
+            _7z_executable = process.find_executable((u'7z',))
+            return _7z_executable
 
     @staticmethod
     def is_available():
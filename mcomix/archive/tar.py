@@ -4,12 +4,18 @@
 
 import os
 import tarfile
+import cStringIO
 import archive_base
 
 class TarArchive(archive_base.NonUnicodeArchive):
-    def __init__(self, archive):
+    def __init__(self, archive, data=None):
+        """ If <data> (a string or a buffer) is passed, it is used as the
+        archive contents instead of reading the file <archive>. """
         super(TarArchive, self).__init__(archive)
-        self.tar = tarfile.open(archive, 'r')
+        if data is None:
+            self.tar = tarfile.open(archive, 'r')
+        else:
+            self.tar = tarfile.open(archive, 'r', fileobj=cStringIO.StringIO(data))
         # Track if archive contents have been listed at least one time: this
         # must be done before attempting to extract contents.
         self._contents_listed = False
@@ -27,13 +33,18 @@ class TarArchive(archive_base.NonUnicodeArchive):
             yield self._unicode_filename(info.name)
         self._contents_listed = True
 
-    def extract(self, filename, destination_dir):
+    def extract_to_buffer(self, filename):
         if not self._contents_listed:
             self.list_contents()
-        new = self._create_file(os.path.join(destination_dir, filename))
         file_object = self.tar.extractfile(self._original_filename(filename))
-        new.write(file_object.read())
+        content = file_object.read()
         file_object.close()
+        return content
+
+    def extract(self, filename, destination_dir):
+        content = self.extract_to_buffer(filename)
+        new = self._create_file(os.path.join(destination_dir, filename))
+        new.write(content)
         new.close()
 
     def iter_extract(self, entries, destination_dir):
@@ -42,6 +53,10 @@ class TarArchive(archive_base.NonUnicodeArchive):
         for f in super(TarArchive, self).iter_extract(entries, destination_dir):
             yield f
 
+    def get_listing_state(self):
+        # Members have to be loaded by tarfile anyway.
+        return None
+
     def close(self):
         self.tar.close()
 
@@ -3,32 +3,127 @@
 """ Unicode-aware wrapper for zipfile.ZipFile. """
 
 import os
+import mmap
+import cStringIO
+import struct
 import zipfile
 import threading
-from contextlib import closing
+import zlib
 
 from mcomix import log
 from mcomix.archive import archive_base
 
-def is_py_supported_zipfile(path):
-    """Check if a given zipfile has all internal files stored with Python supported compression
-    """
-    # Use contextlib's closing for 2.5 compatibility
-    with closing(zipfile.ZipFile(path, 'r')) as zip_file:
-        for file_info in zip_file.infolist():
-            if file_info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
-                return False
-    return True
+# Local file header: signature, and lengths of the variable size fields
+# following it.
+_LOCAL_HEADER_FORMAT = '<4s22x2H'
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FORMAT)
+_LOCAL_HEADER_SIGNATURE = 'PK\x03\x04'
 
 class ZipArchive(archive_base.NonUnicodeArchive):
-    def __init__(self, archive):
+
+    """ Each thread uses its own ZipFile handle, so concurrent
+    extractions are safe (and inflating runs in parallel). """
+    support_concurrent_extractions = True
+
+    """ The central directory is read when opening the archive. """
+    support_extraction_while_listing = True
+
+    def __init__(self, archive, data=None):
+        """ If <data> (a string or a buffer) is passed, it is used as the
+        archive contents instead of reading the file <archive>. """
         super(ZipArchive, self).__init__(archive)
-        self.zip = zipfile.ZipFile(archive, 'r')
+        self._data = data
+        if data is None:
+            self.zip = zipfile.ZipFile(archive, 'r')
+        else:
+            self.zip = zipfile.ZipFile(self._open_file(), 'r')
 
         # Encryption is supported starting with Python 2.6
         self._encryption_supported = hasattr(self.zip, "setpassword")
         self._password = None
 
+        # Per thread handles, opened on demand.
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+
+        # Archive mapping, for zero-copy access to stored entries.
+        self._mmap = None
+        self._mmap_failed = False
+        self._mmap_lock = threading.Lock()
+
+    def is_py_supported(self):
+        """ Returns True if all the files are stored with a compression
+        supported by Python. """
+        for file_info in self.zip.infolist():
+            if file_info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                return False
+        return True
+
+    def _open_file(self):
+        """ Returns a new file object for reading the archive. """
+        if self._data is None:
+            return open(self.archive, 'rb')
+        return cStringIO.StringIO(self._data)
+
+    def _get_zip(self):
+        """ Returns the ZipFile handle of the current thread. """
+        zip = getattr(self._local, 'zip', None)
+        if zip is None:
+            zip = zipfile.ZipFile(self._open_file(), 'r')
+            if self._encryption_supported \
+                and self._password is not None:
+                zip.setpassword(self._password)
+            with self._handles_lock:
+                self._handles.append(zip)
+            self._local.zip = zip
+        return zip
+
+    def _get_mmap(self):
+        """ Returns a mapping of the archive, or None if it can't be mapped. """
+        if self._data is not None:
+            # Already in memory.
+            return self._data
+        with self._mmap_lock:
+            if self._mmap is None and not self._mmap_failed:
+                try:
+                    with open(self.archive, 'rb') as fp:
+                        self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError, OverflowError), e:
+                    log.warning('could not map %s: %s', self.archive, e)
+                    self._mmap_failed = True
+            return self._mmap
+
+    def _map_entry(self, zipinfo):
+        """ Returns a read-only buffer over the data of <zipinfo> in the
+        archive mapping if it is stored uncompressed and unencrypted, or
+        None. Raises BadZipfile if its CRC does not match. """
+        if zipinfo.compress_type != zipfile.ZIP_STORED \
+            or zipinfo.flag_bits & 0x1 \
+            or zipinfo.compress_size != zipinfo.file_size:
+            return None
+        data = self._get_mmap()
+        if data is None:
+            return None
+        # Skip the local file header (its extra field can differ
+        # from the central directory one).
+        offset = zipinfo.header_offset
+        header = data[offset:offset + _LOCAL_HEADER_SIZE]
+        if len(header) != _LOCAL_HEADER_SIZE:
+            return None
+        signature, filename_length, extra_field_length = \
+                struct.unpack(_LOCAL_HEADER_FORMAT, header)
+        if signature != _LOCAL_HEADER_SIGNATURE:
+            return None
+        offset += _LOCAL_HEADER_SIZE + filename_length + extra_field_length
+        if offset + zipinfo.file_size > len(data):
+            return None
+        content = buffer(data, offset, zipinfo.file_size)
+        # Same check as ZipFile.read.
+        if zlib.crc32(content) & 0xffffffff != zipinfo.CRC:
+            raise zipfile.BadZipfile('Bad CRC-32 for file %r' % zipinfo.filename)
+        return content
+
     def iter_contents(self):
         if self._encryption_supported \
             and self._has_encryption()\
@@ -47,13 +142,12 @@ class ZipArchive(archive_base.NonUnicodeArchive):
         for filename in self.zip.namelist():
             yield self._unicode_filename(filename)
 
-    def extract(self, filename, destination_dir):
-        new = self._create_file(os.path.join(destination_dir, filename))
-        content = self.zip.read(self._original_filename(filename))
-        new.write(content)
-        new.close()
-
+    def extract_to_buffer(self, filename):
         zipinfo = self.zip.getinfo(self._original_filename(filename))
+        content = self._map_entry(zipinfo)
+        if content is None:
+            content = self._get_zip().read(self._original_filename(filename))
+
         if len(content) != zipinfo.file_size:
             log.warning(_('%(filename)s\'s extracted size is %(actual_size)d bytes,'
                 ' but should be %(expected_size)d bytes.'
@@ -61,10 +155,33 @@ class ZipArchive(archive_base.NonUnicodeArchive):
                 { 'filename' : filename, 'actual_size' : len(content),
                   'expected_size' : zipinfo.file_size })
 
+        return content
+
+    def extract(self, filename, destination_dir):
+        content = self.extract_to_buffer(filename)
+        new = self._create_file(os.path.join(destination_dir, filename))
+        new.write(content)
+        new.close()
 
+    def get_listing_state(self):
+        if self._encryption_supported and self._has_encryption():
+            # Listing is needed to ask for the password.
+            return None
+        return super(ZipArchive, self).get_listing_state()
 
     def close(self):
         self.zip.close()
+        # Not closed explicitly: buffers returned by extract_to_buffer may
+        # still be in use, it will be unmapped once they are released.
+        self._mmap = None
+        self._data = None
+        with self._handles_lock:
+            for zip in self._handles:
+                # The file was passed to ZipFile, so it is not closed by it.
+                fp = zip.fp
+                zip.close()
+                fp.close()
+            self._handles = []
 
     def _has_encryption(self):
         """ Checks all files in the archive for encryption.
@@ -2,6 +2,8 @@
 
 """ ZIP archive extractor via executable."""
 
+import re
+
 from mcomix import process
 from mcomix.archive import archive_base
 
@@ -11,32 +13,44 @@ _zip_executable = -1
 class ZipExecArchive(archive_base.ExternalExecutableArchive):
     """ ZIP file extractor using unzip executable. """
 
+    support_batch_extractions = True
+
     def _get_executable(self):
         return ZipExecArchive._find_unzip_executable()
 
     def _get_list_arguments(self):
-        return [u'-Z1']
+        return [u'-Zl']
+
+    def _parse_list_output_line(self, line):
+        """ Format: permissions, version, system, size, type, compressed
+        size, method, date, time and name. """
+        match = re.match(r'^\S+\s+\S+\s+\S+\s+(\d+)\s+\S+\s+\d+\s+\S+\s+\S+\s+\S+ (.+)$', line)
+        if not match:
+            return None
+        filename = match.group(2)
+        self._contents.append((filename, int(match.group(1))))
+        return filename
 
     def _get_extract_arguments(self):
         return [u'-p']
 
+    def _get_batch_extract_arguments(self, filenames, list_file):
+        return self._get_extract_arguments() + [self.archive] + filenames
+
+    def _quote_filename(self, filename):
+        # Names are wildcard patterns, escape special characters.
+        return re.sub(r'([\\*?\[\]])', r'\\\1', filename)
+
     @staticmethod
     def _find_unzip_executable():
-        """ Tries to run unzip, and returns 'unzip' on success.
-        Returns None on failure. """
+        """ Returns 'unzip' if found on the system PATH, or None
+        otherwise. """
         global _zip_executable
         if _zip_executable != -1:
             return _zip_executable
         else:
-            proc = process.Process([u'unzip'])
-            fd = proc.spawn()
-            if fd is not None:
-                fd.close()
-                _zip_executable = u'unzip'
-                return u'unzip'
-
-        _zip_executable = None
-        return None
+            _zip_executable = process.find_executable((u'unzip',))
+            return _zip_executable
 
     @staticmethod
     def is_available():
@@ -3,6 +3,7 @@
 import os
 import re
 import shutil
+import cStringIO
 import zipfile
 import tarfile
 import tempfile
@@ -48,6 +49,63 @@ def get_supported_archive_regex():
     formats = [format[2:] for format in formats]
     return re.compile(r'\.(' + '|'.join(formats) + r')\s*$', re.I)
 
+def _is_tar_header(block):
+    """Check if <block> is a valid (uncompressed) tar header block."""
+    if len(block) < tarfile.BLOCKSIZE:
+        return False
+    if block[257:262] == tarfile.POSIX_MAGIC[:5]:
+        return True
+    # Old V7 format: only the checksum can be checked.
+    try:
+        chksum = tarfile.nti(block[148:156])
+    except (ValueError, tarfile.HeaderError):
+        return False
+    return chksum in tarfile.calc_chksums(block[:tarfile.BLOCKSIZE])
+
+def _file_mime_type(fd):
+    """Return the archive type of the file object <fd> or None for
+    non-archives. Zip archives using a compression method not supported
+    by Python are only detected when opening them (see
+    get_archive_handler)."""
+    block = fd.read(tarfile.BLOCKSIZE)
+    magic = block[0:5]
+
+    # Local file header, empty archive, or spanned archive marker.
+    if magic[0:4] in ('PK\x03\x04', 'PK\x05\x06', 'PK\x07\x08'):
+        return constants.ZIP
+
+    # Compressed tars are not checked: that would mean
+    # decompressing them, it is done when opening the archive.
+    if magic.startswith('BZh'):
+        return constants.BZIP2
+    elif magic.startswith('\037\213'):
+        return constants.GZIP
+    elif _is_tar_header(block):
+        return constants.TAR
+
+    if magic[0:4] == 'Rar!':
+        return constants.RAR
+
+    elif magic[0:4] == '7z\xBC\xAF':
+        return constants.SEVENZIP
+
+    # Headers for TAR-XZ and TAR-LZMA that aren't supported by tarfile
+    elif magic[0:5] == '\xFD7zXZ' or magic[0:5] == ']\x00\x00\x80\x00':
+        return constants.SEVENZIP
+
+    elif magic[2:4] == '-l':
+        return constants.LHA
+
+    if magic[0:4] == '%PDF':
+       return constants.PDF
+
+    # Zip archive with some data prepended (e.g. self-extracting):
+    # only its end of central directory record is checked.
+    if zipfile.is_zipfile(fd):
+        return constants.ZIP
+
+    return None
+
 def archive_mime_type(path):
     """Return the archive type of <path> or None for non-archives."""
     try:
@@ -57,51 +115,23 @@ def archive_mime_type(path):
             if not os.access(path, os.R_OK):
                 return None
 
-            if zipfile.is_zipfile(path):
-                if zip.is_py_supported_zipfile(path):
-                    return constants.ZIP
-                else:
-                    return constants.ZIP_EXTERNAL
-
-            fd = open(path, 'rb')
-            magic = fd.read(5)
-            fd.close()
-
-            try:
-                istarfile = tarfile.is_tarfile(path)
-            except IOError:
-                # Tarfile raises an error when accessing certain network shares
-                istarfile = False
-
-            if istarfile and os.path.getsize(path) > 0:
-                if magic.startswith('BZh'):
-                    return constants.BZIP2
-                elif magic.startswith('\037\213'):
-                    return constants.GZIP
-                else:
-                    return constants.TAR
-
-            if magic[0:4] == 'Rar!':
-                return constants.RAR
-
-            elif magic[0:4] == '7z\xBC\xAF':
-                return constants.SEVENZIP
-
-            # Headers for TAR-XZ and TAR-LZMA that aren't supported by tarfile
-            elif magic[0:5] == '\xFD7zXZ' or magic[0:5] == ']\x00\x00\x80\x00':
-                return constants.SEVENZIP
-
-            elif magic[2:] == '-l':
-                return constants.LHA
-
-            if magic[0:4] == '%PDF':
-               return constants.PDF
+            # Only open the file once (slow on network shares).
+            with open(path, 'rb') as fd:
+                return _file_mime_type(fd)
 
     except Exception:
         log.warning(_('! Could not read %s'), path)
 
     return None
 
+def buffer_mime_type(data):
+    """Return the archive type of the archive in memory <data> (a string
+    or a buffer) or None for non-archives."""
+    try:
+        return _file_mime_type(cStringIO.StringIO(data))
+    except Exception:
+        return None
+
 def get_archive_info(path):
     """Return a tuple (mime, num_pages, size) with info about the archive
     at <path>, or None if <path> doesn't point to a supported
@@ -135,14 +165,28 @@ def get_archive_handler(path, type=None):
         type = archive_mime_type(path)
 
     if type == constants.ZIP:
-        return zip.ZipArchive(path)
-    elif type == constants.ZIP_EXTERNAL and zip_external.ZipExecArchive.is_available():
+        try:
+            archive = zip.ZipArchive(path)
+        except zipfile.BadZipfile, e:
+            log.warning('Not a zip archive: %s (%s)', path, e)
+            return None
+        if archive.is_py_supported():
+            return archive
+        archive.close()
+        type = constants.ZIP_EXTERNAL
+
+    if type == constants.ZIP_EXTERNAL and zip_external.ZipExecArchive.is_available():
         return zip_external.ZipExecArchive(path)
     elif type == constants.ZIP_EXTERNAL and sevenzip.SevenZipArchive.is_available():
         log.info('Using Sevenzip for unsupported zip archives.')
         return sevenzip.SevenZipArchive(path)
     elif type in (constants.TAR, constants.GZIP, constants.BZIP2):
-        return tar.TarArchive(path)
+        try:
+            return tar.TarArchive(path)
+        except tarfile.TarError, e:
+            # Compressed files are not checked by archive_mime_type.
+            log.warning('Not a tar archive: %s (%s)', path, e)
+            return None
     elif type == constants.RAR and rar.RarArchive.is_available():
         return rar.RarArchive(path)
     elif type == constants.RAR and sevenzip.SevenZipArchive.is_available():
@@ -160,6 +204,35 @@ def get_archive_handler(path, type=None):
     else:
         return None
 
+def get_buffer_archive_handler(name, data, type=None):
+    """ Same as <get_archive_handler>, for an archive already in memory:
+    <data> (a string or a buffer), using <name> as its path. Only formats
+    handled by Python modules are supported, None is returned for other
+    formats.
+    """
+    if type is None:
+        type = buffer_mime_type(data)
+
+    if type == constants.ZIP:
+        try:
+            archive = zip.ZipArchive(name, data=data)
+        except zipfile.BadZipfile, e:
+            log.warning('Not a zip archive: %s (%s)', name, e)
+            return None
+        if archive.is_py_supported():
+            return archive
+        # Has to be extracted to disk for an external executable.
+        archive.close()
+        return None
+    elif type in (constants.TAR, constants.GZIP, constants.BZIP2):
+        try:
+            return tar.TarArchive(name, data=data)
+        except tarfile.TarError, e:
+            log.warning('Not a tar archive: %s (%s)', name, e)
+            return None
+    else:
+        return None
+
 def get_recursive_archive_handler(path, destination_dir, type=None):
     """ Same as <get_archive_handler> but the handler will transparently handle
     archives within archives.
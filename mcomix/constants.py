@@ -6,6 +6,8 @@ import re
 ZIP, RAR, TAR, GZIP, BZIP2, PDF, SEVENZIP, LHA, ZIP_EXTERNAL = range(9)
 
 SUPPORTED_IMAGE_REGEX = re.compile(r'\.(jpg|jpeg|png|gif|tif|tiff|bmp|ppm|pgm|pbm)\s*$', re.I)
+# Image formats already compressed (no point in compressing them again).
+COMPRESSED_IMAGE_REGEX = re.compile(r'\.(jpg|jpeg|png|gif)\s*$', re.I)
 
 ZIP_FORMATS = (
         ('application/x-zip', 'application/zip', 'application/x-zip-compressed', 'application/x-cbz'),
@@ -0,0 +1,173 @@
+""" Page background color and frames detection, optionally done by a pool
+of worker processes (so it's not limited by the GIL). """
+
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+from mcomix import image_tools
+from mcomix import log
+from mcomix.smart_scroller import Frame, Rect, SmartScroller
+
+# Where to put page data shared with worker processes: use a memory
+# backed filesystem if available.
+if os.path.isdir('/dev/shm'):
+    SHARED_DIR = '/dev/shm'
+else:
+    SHARED_DIR = None
+
+# Frames are first looked for on pages downscaled by that factor, see
+# SmartScroller (same results, faster).
+PYRAMID_FACTOR = 4
+
+def detect(image, bgcolor=None, left_to_right=True, detect_frames=True,
+           luminance=None, scale=1):
+    """ Detect the background color (unless <bgcolor> is passed) and the
+    frames (if <detect_frames> is True) of PIL <image>.
+
+    Frames are detected on <luminance> if not None, the (data, stride)
+    luminance plane of <image> (see BaseImage.to_luminance), instead of
+    converting <image>. If <scale> is more than 1, they are detected on
+    the image downscaled by that factor (see SmartScroller.setup_image).
+
+    Return a (bgcolor, frames) tuple, with frames a list of Frame, or None
+    if not detected. """
+    if bgcolor is None:
+        bgcolor = image_tools.get_most_common_edge_colour(image)
+    frames = None
+    if detect_frames:
+        scroller = SmartScroller(left_to_right=left_to_right,
+                                 pyramid_factor=PYRAMID_FACTOR)
+        if luminance is None:
+            scroller.setup_image(image, bgcolor, scale=scale)
+        else:
+            data, stride = luminance
+            scroller.setup_luminance(data, image.size, bgcolor,
+                                     stride=stride, scale=scale)
+        frames = scroller._frames
+    return bgcolor, frames
+
+def _detect_shared(edges, bgcolor, path, size, stride, left_to_right, scale):
+    """ Worker side of DetectionPool: detect the background color on the
+    (data, size) RGB <edges> (unless <bgcolor> is passed), and the frames
+    on the luminance plane in <path> (if not None), only returning plain
+    tuples to the parent process. """
+    if bgcolor is None:
+        data, edges_size = edges
+        edges = Image.frombuffer('RGB', edges_size, data, 'raw', 'RGB', 0, 1)
+        bgcolor = image_tools.get_most_common_colour(edges)
+    if path is None:
+        return tuple(bgcolor), None
+    with open(path, 'rb') as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        image = Image.frombuffer('L', size, data, 'raw', 'L', stride, 1)
+        bgcolor, frames = detect(image, bgcolor=bgcolor,
+                                 left_to_right=left_to_right,
+                                 scale=scale)
+        del image
+    finally:
+        data.close()
+    frames = [tuple(f.rect) for f in frames]
+    return tuple(bgcolor), frames
+
+def frames_from_rects(rects):
+    """ Convert a list of (x, y, w, h) tuples, as returned by worker
+    processes, back to a list of Frame. """
+    return [Frame(Rect(*r), n, None) for n, r in enumerate(rects)]
+
+class DetectionResult(object):
+    """ Pending detection, see DetectionPool.detect_async. """
+
+    def __init__(self, pool, result, path):
+        self._pool = pool
+        self._result = result
+        self._path = path
+
+    def get(self):
+        """ Wait for the detection to be done, and return its (bgcolor,
+        frames) tuple, like detect. """
+        try:
+            bgcolor, rects = self._result.get()
+        finally:
+            if self._path is not None:
+                self._pool._release(self._path)
+        frames = None
+        if rects is not None:
+            frames = frames_from_rects(rects)
+        return bgcolor, frames
+
+class DetectionPool(object):
+
+    def __init__(self, processes=None):
+        """ Create a pool of <processes> worker processes (default to the
+        number of CPUs). Must be created before starting any thread. """
+        self._pool = multiprocessing.Pool(processes)
+        self._lock = threading.Lock()
+        # Shared files not yet released.
+        self._paths = set()
+
+    def _share(self, data):
+        """ Copy <data> to a new shared file, and return its path. """
+        fd, path = tempfile.mkstemp(prefix='comicplayer.', dir=SHARED_DIR)
+        with self._lock:
+            self._paths.add(path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def _release(self, path):
+        with self._lock:
+            if not path in self._paths:
+                return
+            self._paths.remove(path)
+        os.unlink(path)
+
+    def detect_async(self, image, bgcolor=None, left_to_right=True,
+                     detect_frames=True, luminance=None, scale=1):
+        """ Same as detect, but done by a worker process, and returning a
+        DetectionResult. Only the luminance plane (converted from <image>
+        if <luminance> is None) is shared with it, and the edges of <image>
+        if <bgcolor> is None. """
+        edges = None
+        if bgcolor is None:
+            edges = image_tools.get_edges(image)
+            edges = (edges.tostring(), edges.size)
+        path, stride = None, 0
+        if detect_frames:
+            if luminance is None:
+                luminance = image.convert('L').tostring(), image.size[0]
+            data, stride = luminance
+            path = self._share(data)
+        try:
+            result = self._pool.apply_async(_detect_shared,
+                                            (edges, bgcolor, path, image.size, stride,
+                                             left_to_right, scale))
+        except:
+            if path is not None:
+                self._release(path)
+            raise
+        return DetectionResult(self, result, path)
+
+    def detect(self, image, bgcolor=None, left_to_right=True,
+               detect_frames=True, luminance=None, scale=1):
+        """ Synchronous version of detect_async. """
+        return self.detect_async(image, bgcolor=bgcolor,
+                                 left_to_right=left_to_right,
+                                 detect_frames=detect_frames,
+                                 luminance=luminance,
+                                 scale=scale).get()
+
+    def close(self):
+        """ Wait for pending detections and stop worker processes. """
+        self._pool.close()
+        self._pool.join()
+        for path in list(self._paths):
+            log.debug('removing unreleased detection data: %s', path)
+            self._release(path)
+
+# vim: expandtab:sw=4:ts=4
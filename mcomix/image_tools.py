@@ -1,106 +1,84 @@
 """image_tools.py - Various image manipulations."""
 
-import operator
-
-def get_most_common_edge_colour(image, edge=2):
-    """Return the most commonly occurring pixel value along the four edges
-    of <image>. The return value is a sequence, (r, g, b), with 16 bit
-    values.
-
-    Note: This could be done more cleanly with subpixbuf(), but that
-    doesn't work as expected together with get_pixels().
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Edge colors are grouped by rounding each component to that step.
+COLOR_GROUP_STEP = 10
+
+def _color_group(value, steps=COLOR_GROUP_STEP):
+    """ Return the index of the group of color component <value>: the
+    nearest multiple of <steps>. """
+    return (value + steps // 2) // steps
+
+def get_edges(image, edge=2, stride=1):
+    """ Return an RGB image of the left and right edges of <image>, <edge>
+    pixels wide, side by side. Only one row every <stride> rows is kept. """
+    width, height = image.size
+    edge = min(edge, width, height)
+    # Pasting converts other modes, e.g. grayscale, or padded RGBX.
+    edges = Image.new('RGB', (2 * edge, height))
+    edges.paste(image.crop((0, 0, edge, height)), (0, 0))
+    edges.paste(image.crop((width - edge, 0, width, height)), (edge, 0))
+    if stride > 1:
+        edges = edges.resize((2 * edge, (height + stride - 1) // stride), Image.NEAREST)
+    return edges
+
+def _most_common_colour_numpy(edges):
+    pixels = numpy.frombuffer(edges.tostring(), dtype=numpy.uint8).reshape(-1, 3)
+    nb_groups = _color_group(255) + 1
+    groups = _color_group(pixels.astype(numpy.intp))
+    groups = (groups[:, 0] * nb_groups + groups[:, 1]) * nb_groups + groups[:, 2]
+    # Most common group, then most common color in that group.
+    prominent_group = numpy.bincount(groups).argmax()
+    pixels = pixels[groups == prominent_group].astype(numpy.uint32)
+    colors = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    colors, counts = numpy.unique(colors, return_counts=True)
+    color = int(colors[counts.argmax()])
+    return (color >> 16, (color >> 8) & 0xff, color & 0xff)
+
+def _most_common_colour_pil(edges):
+    table = [_color_group(value) for value in xrange(256)]
+    # Map color groups to [count, most common color count, most common color].
+    groups = {}
+    for count, color in edges.getcolors(edges.size[0] * edges.size[1]):
+        r, g, b = color
+        key = (table[r], table[g], table[b])
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [count, count, color]
+            continue
+        group[0] += count
+        if count > group[1] or (count == group[1] and color < group[2]):
+            group[1:] = count, color
+    # Like with numpy, ties are resolved in favor of the lowest group.
+    prominent_group = None
+    for key in sorted(groups):
+        if prominent_group is None or groups[key][0] > prominent_group[0]:
+            prominent_group = groups[key]
+    return prominent_group[2]
+
+def get_most_common_colour(edges):
+    """Return the most common color of RGB image <edges>, as returned by
+    get_edges, see get_most_common_edge_colour."""
+    if numpy is not None:
+        return _most_common_colour_numpy(edges)
+    return _most_common_colour_pil(edges)
+
+def get_most_common_edge_colour(image, edge=2, stride=1):
+    """Return the most commonly occurring pixel value along the left and
+    right edges of <image>, <edge> pixels wide. The return value is a
+    sequence, (r, g, b), with 8 bit values.
+
+    Colors are first grouped (see COLOR_GROUP_STEP) to compensate for
+    dirty colors where no clear dominating color can be made out: the most
+    common color of the group with the most pixels is returned. Only one
+    row every <stride> rows is sampled.
     """
-
-    def group_colors(colors, steps=10):
-        """ This rounds a list of colors in C{colors} to the next nearest value,
-        i.e. 128, 83, 10 becomes 130, 85, 10 with C{steps}=5. This compensates for
-        dirty colors where no clear dominating color can be made out.
-
-        @return: The color that appears most often in the prominent group."""
-
-        # Start group
-        group = (0, 0, 0)
-        # List of (count, color) pairs, group contains most colors
-        colors_in_prominent_group = []
-        color_count_in_prominent_group = 0
-        # List of (count, color) pairs, current color group
-        colors_in_group = []
-        color_count_in_group = 0
-
-        for count, color in colors:
-
-            # Round color
-            rounded = [0] * len(color)
-            for i, color_value in enumerate(color):
-                if steps % 2 == 0:
-                    middle = steps // 2
-                else:
-                    middle = steps // 2 + 1
-
-                remainder = color_value % steps
-                if remainder >= middle:
-                    color_value = color_value + (steps - remainder)
-                else:
-                    color_value = color_value - remainder
-
-                rounded[i] = min(255, max(0, color_value))
-
-            # Change prominent group if necessary
-            if rounded == group:
-                # Color still fits in the previous color group
-                colors_in_group.append((count, color))
-                color_count_in_group += count
-            else:
-                # Color group changed, check if current group has more colors
-                # than last group
-                if color_count_in_group > color_count_in_prominent_group:
-                    colors_in_prominent_group = colors_in_group
-                    color_count_in_prominent_group = color_count_in_group
-
-                group = rounded
-                colors_in_group = [ (count, color) ]
-                color_count_in_group = count
-
-        # Cleanup if only one edge color group was found
-        if color_count_in_group > color_count_in_prominent_group:
-            colors_in_prominent_group = colors_in_group
-
-        colors_in_prominent_group.sort(key=operator.itemgetter(0), reverse=True)
-        # List is now sorted by color count, first color appears most often
-        return colors_in_prominent_group[0][1]
-
-    def get_edge_pixbuf(image, side, edge):
-        """ Returns a image corresponding to the side passed in <side>.
-        Valid sides are 'left', 'right', 'top', 'bottom'. """
-        width, height = image.size
-        edge = min(edge, width, height)
-
-        if side == 'left':
-            box = (0, 0, edge, height)
-        elif side == 'right':
-            box = (width - edge, 0, width, height)
-        elif side == 'top':
-            box = (0, 0, width, edge)
-        elif side == 'bottom':
-            box = (0, height - edge, width, height)
-        else:
-            assert False, 'Invalid edge side'
-
-        subpix = image.crop(box)
-
-        return subpix
-
-    left_edge = get_edge_pixbuf(image, 'left', edge)
-    right_edge = get_edge_pixbuf(image, 'right', edge)
-
-    # Find all edge colors. Color count is separate for all four edges
-    ungrouped_colors = []
-    for edge in (left_edge, right_edge):
-        ungrouped_colors.extend(edge.getcolors(edge.size[0] * edge.size[1]))
-
-    # Sum up colors from all edges
-    ungrouped_colors.sort(key=operator.itemgetter(1))
-    most_used = group_colors(ungrouped_colors)
-    return most_used
+    return get_most_common_colour(get_edges(image, edge, stride))
 
 # vim: expandtab:sw=4:ts=4
@@ -101,6 +101,41 @@ class Process:
         before returning a tuple (stdoutdata, stderrdata). """
         return self._proc.communicate(input)
 
+def _get_application_directories():
+    """ Returns the directories applications may be bundled in: where
+    MComix is installed, and on Windows (which looks there too when
+    spawning a process) those of the executable and the current one. """
+    directories = [os.path.dirname(os.path.abspath(sys.argv[0]))]
+    if sys.platform == 'win32':
+        directories.append(os.path.dirname(os.path.abspath(sys.executable)))
+        directories.append(os.getcwd())
+    return directories
+
+def find_executable(candidates):
+    """ Look for the first of <candidates> found on the system PATH, and
+    return it (as found in <candidates>), or its full path if found in
+    the application directory instead (see _get_application_directories),
+    or None if none were found. Cheaper than spawning each candidate to
+    check if it is available. """
+    paths = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    if sys.platform == 'win32':
+        extensions = os.environ.get('PATHEXT', '.EXE').split(os.pathsep)
+    else:
+        extensions = ['']
+    def is_executable(path):
+        return os.path.isfile(path) and os.access(path, os.X_OK)
+    for command in candidates:
+        for directory in _get_application_directories():
+            for ext in extensions:
+                executable = os.path.join(directory, command + ext)
+                if is_executable(executable):
+                    return executable
+        for path in paths:
+            for ext in extensions:
+                if is_executable(os.path.join(path, command + ext)):
+                    return command
+    return None
+
 def Win32Popen(cmd):
     """ Spawns a new process on Win32. cmd is a list of parameters. 
     This method's sole purpose is calling CreateProcessW, not
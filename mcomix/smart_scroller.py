@@ -1,4 +1,6 @@
 
+from PIL import Image
+
 from mcomix import image_tools
 from mcomix import log
 
@@ -13,9 +15,18 @@ except ImportError:
         import pyximport; pyximport.install()
         from mcomix.smart_scroller_fastcore import *
     except ImportError:
-        log.warning('Not using smart_scroller_fastcore!')
-        from mcomix.smart_scroller_slowcore import *
         _using_fastcore = False
+        try:
+            from mcomix.smart_scroller_numpycore import *
+            log.info('Using smart_scroller_numpycore.')
+        except ImportError:
+            log.warning('Not using smart_scroller_fastcore!')
+            from mcomix.smart_scroller_slowcore import *
+
+try:
+    from mcomix.smart_scroller_numpycore import LineProfiles, PyramidProfiles, image_to_array
+except ImportError:
+    LineProfiles = None
 
 Rect = namedtuple('Rect', 'x y w h')
 Rect.__repr__ = lambda r: '%+d%+d:%ux%u' % (r.x, r.y, r.w, r.h)
@@ -31,9 +42,13 @@ Frame.__repr__ = lambda f: '%u%s:%s' % (f.number, '' if f.split is None else '.%
 
 class SmartScroller(object):
 
-    def __init__(self, left_to_right=True, debug=False):
+    def __init__(self, left_to_right=True, debug=False, pyramid_factor=None):
+        """ If <pyramid_factor> is not None, lines are first checked on the
+        page downscaled by that factor (4 or 8), see PyramidProfiles: same
+        frames, faster on large pages. Needs numpy. """
         self._debug = debug
         self._left_to_right = left_to_right
+        self._pyramid_factor = pyramid_factor
         self._max_imperfection_size = 3
         self._luminance_threshold = 16
         self._frames = []
@@ -42,26 +57,43 @@ class SmartScroller(object):
         self._smart_scroll_possible = False
         self._image_width = 0
         self._image_height = 0
+        self._image = None
+        self._profiles = None
         self._view_x = 0
         self._view_y = 0
         self._view_width = 0
         self._view_height = 0
 
-    def _count_lines(self, bg, start_step, step_size, nb_steps, start_line, line_pitch, max_lines):
-        pos = start_step * step_size + start_line * line_pitch
+    def _count_lines(self, bg, horizontal, first_line, reverse, seg_start, seg_len, max_lines):
+        """ Count consecutive lines that are background (or not if <bg> is
+        False), stopping after <max_lines>. Lines are rows if <horizontal>,
+        columns otherwise, and are walked starting from <first_line> in
+        increasing order, or decreasing order if <reverse>. Only the part
+        of each line starting at <seg_start> and of length <seg_len> is
+        considered. """
+        if self._profiles is not None:
+            return self._profiles.count_lines(bg, horizontal, first_line, reverse,
+                                              seg_start, seg_len, max_lines)
+        if horizontal:
+            step_size, line_pitch = 1, self._image_width
+        else:
+            step_size, line_pitch = self._image_width, 1
+        pos = seg_start * step_size + first_line * line_pitch
+        if reverse:
+            line_pitch = -line_pitch
         return count_lines(self._image, self._max_imperfection_size, bg, pos,
-                           step_size, nb_steps, line_pitch, max_lines)
+                           step_size, seg_len, line_pitch, max_lines)
 
     def _crop_side(self, rect, side):
         x0, y0, x1, y1 = rect.points
         if   'top' == side:
-            y0 += self._count_lines(True, x0, 1, rect.w, y0, +self._image_width, rect.h)
+            y0 += self._count_lines(True, True, y0, False, x0, rect.w, rect.h)
         elif 'bottom' == side:
-            y1 -= self._count_lines(True, x0, 1, rect.w, -y1, -self._image_width, rect.h)
+            y1 -= self._count_lines(True, True, y1, True, x0, rect.w, rect.h)
         elif 'left' == side:
-            x0 += self._count_lines(True, y0, +self._image_width, rect.h, x0, +1, rect.w)
+            x0 += self._count_lines(True, False, x0, False, y0, rect.h, rect.w)
         elif 'right' == side:
-            x1 -= self._count_lines(True, y0, +self._image_width, rect.h, -x1, -1, rect.w)
+            x1 -= self._count_lines(True, False, x1, True, y0, rect.h, rect.w)
         else:
             raise ValueError('invalid side argument: %s' % side)
         return Rect.from_points(x0, y0, x1, y1)
@@ -86,14 +118,14 @@ class SmartScroller(object):
                 continue
             if horizontal:
                 min_nb_lines = self._min_frame_height
-                start_step, step_size, nb_steps = rect.x, 1, rect.w
-                start_line, line_pitch, nb_lines = rect.y, self._image_width, rect.h
+                seg_start, seg_len = rect.x, rect.w
+                start_line, nb_lines = rect.y, rect.h
                 first_split = lambda: (rect.x, rect.y, rect.w, split_size)
                 second_split = lambda: (rect.x, split.y + split.h, rect.w, rect.h - split.h)
             else:
                 min_nb_lines = self._min_frame_width
-                start_step, step_size, nb_steps = rect.y, self._image_width, rect.h
-                start_line, line_pitch, nb_lines = rect.x, 1, rect.w
+                seg_start, seg_len = rect.y, rect.h
+                start_line, nb_lines = rect.x, rect.w
                 first_split = lambda: (rect.x, rect.y, split_size, rect.h)
                 second_split = lambda: (split.x + split.w, rect.y, rect.w - split.w, rect.h)
             if nb_lines <= min_nb_lines * 2:
@@ -101,8 +133,8 @@ class SmartScroller(object):
             cur_line = start_line + min_nb_lines
             end_line = cur_line + nb_lines - 2 * min_nb_lines
             while cur_line < end_line:
-                nb_fg_lines = self._count_lines(False, start_step, step_size, nb_steps,
-                                                cur_line, line_pitch, end_line - cur_line)
+                nb_fg_lines = self._count_lines(False, horizontal, cur_line, False,
+                                                seg_start, seg_len, end_line - cur_line)
                 split_size = cur_line + nb_fg_lines - start_line + 1
                 split = Rect(*first_split())
                 first_frames = self._find_frames(split,
@@ -113,8 +145,8 @@ class SmartScroller(object):
                     if cur_line >= end_line:
                         break
                     # Skip blank.
-                    nb_bg_lines = self._count_lines(True, start_step, step_size, nb_steps,
-                                                    cur_line, line_pitch, end_line - cur_line)
+                    nb_bg_lines = self._count_lines(True, horizontal, cur_line, False,
+                                                    seg_start, seg_len, end_line - cur_line)
                     cur_line += nb_bg_lines
                     continue
                 split = Rect(*second_split())
@@ -176,7 +208,22 @@ class SmartScroller(object):
             y += split_height
         return splits
 
-    def setup_image(self, im, bg):
+    def _rescale_rect(self, rect, from_size, to_size):
+        """ Return <rect> of an image of <from_size>, scaled to cover the
+        same area of the image at <to_size>. """
+        from_width, from_height = from_size
+        to_width, to_height = to_size
+        x0 = rect.x * to_width / from_width
+        y0 = rect.y * to_height / from_height
+        x1 = min(((rect.x + rect.w) * to_width + from_width - 1) / from_width, to_width)
+        y1 = min(((rect.y + rect.h) * to_height + from_height - 1) / from_height, to_height)
+        return Rect(x0, y0, x1 - x0, y1 - y0)
+
+    def setup_image(self, im, bg, scale=1):
+        """ Detect the frames of PIL image <im>, with background color <bg>.
+        If <scale> is more than 1, detection is done on the image downscaled
+        by that factor (faster, but less precise), frames are then rescaled
+        to <im> size. """
 
         if self._debug:
             self._debug_images = [im]
@@ -184,40 +231,65 @@ class SmartScroller(object):
         bg_luminance = (bg[0] * 299 + bg[1] * 587 + bg[2] * 114) / 1000
         self._bg = bg
 
+        width, height = im.size
+
         # Contert to grayscale.
-        im = im.convert(mode='L')
+        if 'L' != im.mode:
+            im = im.convert(mode='L')
+        if scale > 1:
+            im = im.resize((max(width / scale, 1), max(height / scale, 1)), Image.BILINEAR)
         if self._debug:
             self._debug_images.append(im)
 
         # Convert to 2 tones: background, and the rest.
-        table = []
-        for n in xrange(256):
-            if n < bg_luminance - self._luminance_threshold or \
-               n > bg_luminance + self._luminance_threshold:
-                n = 255
-            else:
-                n = 0
-            table.append(n)
+        low = bg_luminance - self._luminance_threshold
+        high = bg_luminance + self._luminance_threshold
+        table = [0 if low <= n <= high else 255 for n in xrange(256)]
         im = im.point(table)
         if self._debug:
             self._debug_images.append(im)
 
         self._image_width, self._image_height = im.size
-        self._min_frame_width = max(64, self._image_width / 16)
-        self._min_frame_height = max(64, self._image_height / 16)
-        if _using_fastcore:
+        # Minimum sizes are for the original image.
+        self._min_frame_width = max(64, width / 16) * self._image_width / width
+        self._min_frame_height = max(64, height / 16) * self._image_height / height
+        # Not worth it for small pages.
+        if LineProfiles is not None and self._pyramid_factor is not None and \
+           min(im.size) >= self._pyramid_factor * 256:
+            image = image_to_array(im).reshape(self._image_height, self._image_width)
+            self._profiles = PyramidProfiles(image, self._max_imperfection_size,
+                                             self._pyramid_factor)
+        elif _using_fastcore:
             self._image = im.tostring()
+        elif LineProfiles is not None:
+            image = image_to_array(im).reshape(self._image_height, self._image_width)
+            self._profiles = LineProfiles(image, self._max_imperfection_size)
         else:
             self._image = im.getdata()
 
         rect = Rect(0, 0, self._image_width, self._image_height)
-        frames = self._find_frames(rect)
+        try:
+            frames = self._find_frames(rect)
+        finally:
+            # Only needed for detection.
+            self._image = None
+            self._profiles = None
         if frames is None:
-            self._frames = [Frame(rect, 0, None)]
-        else:
-            self._frames = [Frame(rect, n, None) for n, rect in enumerate(frames)]
+            frames = [rect]
+        if (width, height) != im.size:
+            frames = [self._rescale_rect(rect, im.size, (width, height))
+                      for rect in frames]
+            self._image_width, self._image_height = width, height
+        self._frames = [Frame(rect, n, None) for n, rect in enumerate(frames)]
         self._current_frames = (0, 0)
 
+    def setup_luminance(self, data, size, bg, stride=0, scale=1):
+        """ Same as setup_image, but from the luminance plane <data> (an
+        object supporting the buffer protocol) of an image of <size>: one
+        byte per pixel, in rows of <stride> bytes (0 if not padded). """
+        im = Image.frombuffer('L', size, data, 'raw', 'L', stride, 1)
+        self.setup_image(im, bg, scale=scale)
+
     def setup_view(self, x, y, width, height):
         self._view_x = 0
         self._view_y = 0
@@ -0,0 +1,243 @@
+
+import numpy
+
+__all__ = ['count_lines', 'image_to_array', 'LineProfiles', 'PyramidProfiles']
+
+# Number of lines checked at once by count_lines (doubled after each chunk).
+_MIN_CHUNK_LINES = 16
+
+
+def image_to_array(im):
+    """ Convert 'L' mode PIL image <im> to a flat uint8 array. """
+    return numpy.frombuffer(im.tostring(), dtype=numpy.uint8)
+
+
+def _background_lines(fg, max_ignore_size):
+    """ For each line of the boolean 2D array <fg> (True for foreground
+    pixels), return True if it does not contain more than <max_ignore_size>
+    consecutive foreground pixels. """
+    nb_lines, nb_steps = fg.shape
+    window = max_ignore_size + 1
+    if nb_steps < window:
+        return numpy.ones(nb_lines, dtype=bool)
+    # Prefix sums of foreground pixels: a line is not background if any
+    # window of <max_ignore_size> + 1 pixels is fully foreground.
+    sums = numpy.zeros((nb_lines, nb_steps + 1), dtype=numpy.int32)
+    numpy.cumsum(fg, axis=1, out=sums[:, 1:])
+    return ((sums[:, window:] - sums[:, :-window]) < window).all(axis=1)
+
+
+def count_lines(image, max_ignore_size, want_bg, start_step, step_size, nb_steps, line_pitch, max_lines):
+    steps = numpy.arange(nb_steps) * step_size
+    count = 0
+    chunk = _MIN_CHUNK_LINES
+    while count < max_lines:
+        nb_lines = min(chunk, max_lines - count)
+        lines = start_step + (count + numpy.arange(nb_lines)) * line_pitch
+        fg = image[lines[:, numpy.newaxis] + steps] != 0
+        is_bg = _background_lines(fg, max_ignore_size)
+        mismatch = numpy.flatnonzero(is_bg != bool(want_bg))
+        if len(mismatch) > 0:
+            return count + int(mismatch[0])
+        count += nb_lines
+        chunk *= 2
+    return count
+
+
+class LineProfiles(object):
+    """ Tables precomputed once per image, used to tell in constant time if
+    a segment of a row or column is background: i.e. does not contain more
+    than <max_ignore_size> consecutive foreground pixels. """
+
+    def __init__(self, image, max_ignore_size):
+        """ <image> is a 2D uint8 array (height x width), with 0 for
+        background pixels. """
+        fg = image != 0
+        self._window = max_ignore_size + 1
+        self._rows = self._window_sums(fg, 1)
+        self._columns = self._window_sums(fg, 0)
+
+    def _window_sums(self, fg, axis):
+        """ For each line of <fg> along <axis> (1 for rows, 0 for columns),
+        return the prefix sums of foreground windows: sums[line, n] is the
+        number of fully foreground windows of <self._window> pixels starting
+        before position n. """
+        length = fg.shape[axis]
+        nb_windows = max(length - self._window + 1, 0)
+        if length < 65536:
+            dtype = numpy.uint16
+        else:
+            dtype = numpy.uint32
+        shape = list(fg.shape)
+        shape[axis] = nb_windows + 1
+        sums = numpy.zeros(shape, dtype=dtype)
+        if nb_windows > 0:
+            def windows(start):
+                index = [slice(None), slice(None)]
+                index[axis] = slice(start, start + nb_windows)
+                return fg[tuple(index)]
+            full = windows(0).copy()
+            for n in range(1, self._window):
+                full &= windows(n)
+            if 1 == axis:
+                numpy.cumsum(full, axis=1, dtype=dtype, out=sums[:, 1:])
+            else:
+                # Much faster than cumsum along the first axis.
+                sums[1:] = full
+                for n in range(1, nb_windows + 1):
+                    numpy.add(sums[n - 1], sums[n], out=sums[n])
+        if 0 == axis:
+            # Index by [column, position], like rows.
+            sums = sums.T
+        return sums
+
+    def background(self, horizontal, lines, seg_start, seg_len):
+        """ Return a boolean array telling for each line of the <lines>
+        slice if its segment is background. """
+        if horizontal:
+            sums = self._rows
+        else:
+            sums = self._columns
+        if seg_len < self._window:
+            # Too short to contain an imperfection.
+            return numpy.ones(len(sums[lines, 0]), dtype=bool)
+        seg_end = seg_start + seg_len - self._window + 1
+        return sums[lines, seg_end] == sums[lines, seg_start]
+
+    def count_lines(self, want_bg, horizontal, first_line, reverse, seg_start, seg_len, max_lines):
+        """ Same as SmartScroller._count_lines. """
+        if max_lines <= 0:
+            return 0
+        is_bg = self.background(horizontal, _lines(first_line, reverse, max_lines),
+                                seg_start, seg_len)
+        mismatch = numpy.flatnonzero(is_bg != bool(want_bg))
+        if len(mismatch) > 0:
+            return int(mismatch[0])
+        return max_lines
+
+
+class PyramidProfiles(object):
+    """ Same as LineProfiles, but tables are only built for a version of the
+    image downscaled by <factor>, telling if whole blocks of lines are
+    background or not. Lines of blocks it can't tell about are checked at
+    full resolution: results are the same, visiting much fewer pixels. """
+
+    def __init__(self, image, max_ignore_size, factor):
+        """ <image> is a 2D uint8 array (height x width), with 0 for
+        background pixels. """
+        height, width = image.shape
+        self._image = image.ravel()
+        self._width = width
+        self._height = height
+        # If too many blocks have to be checked at full resolution (e.g.
+        # noisy pages), fall back to LineProfiles for the full image.
+        self._nb_checked_blocks = 0
+        self._max_checked_blocks = height * width / (factor * 4096)
+        self._full_profiles = None
+        self._max_ignore_size = max_ignore_size
+        self._factor = factor
+        blocks_height = (height + factor - 1) / factor
+        blocks_width = (width + factor - 1) / factor
+        fg = numpy.zeros((blocks_height * factor, blocks_width * factor), dtype=bool)
+        fg[:height, :width] = image != 0
+        # Blocks with at least one foreground pixel: lines crossing none
+        # of them are background.
+        self._any = LineProfiles(_reduce_blocks(fg, factor, numpy.logical_or), 0)
+        # Blocks with only foreground pixels: lines crossing enough of
+        # them in a row are not background.
+        window = (max_ignore_size + factor) / factor
+        self._all = LineProfiles(_reduce_blocks(fg, factor, numpy.logical_and), window - 1)
+
+    def _block_lines(self, line, reverse, nb_blocks):
+        """ Return the number of lines from <line> to the end of the
+        <nb_blocks>th block, walking in reverse order if <reverse>. """
+        block = line / self._factor
+        if reverse:
+            return line - (block - nb_blocks + 1) * self._factor + 1
+        return (block + nb_blocks) * self._factor - line
+
+    def count_lines(self, want_bg, horizontal, first_line, reverse, seg_start, seg_len, max_lines):
+        """ Same as SmartScroller._count_lines. """
+        if max_lines <= 0:
+            return 0
+        if self._full_profiles is not None:
+            return self._full_profiles.count_lines(want_bg, horizontal, first_line, reverse,
+                                                   seg_start, seg_len, max_lines)
+        factor = self._factor
+        seg_end = seg_start + seg_len
+        # Blocks overlapping the segment.
+        any_start = seg_start / factor
+        any_len = (seg_end + factor - 1) / factor - any_start
+        # Blocks inside the segment.
+        all_start = (seg_start + factor - 1) / factor
+        all_len = max(seg_end / factor - all_start, 0)
+        if want_bg:
+            is_match = lambda blocks: self._any.background(horizontal, blocks, any_start, any_len)
+            is_mismatch = lambda blocks: ~self._all.background(horizontal, blocks, all_start, all_len)
+        else:
+            is_match = lambda blocks: ~self._all.background(horizontal, blocks, all_start, all_len)
+            is_mismatch = lambda blocks: self._any.background(horizontal, blocks, any_start, any_len)
+        count = 0
+        while count < max_lines:
+            line = first_line + (-count if reverse else count)
+            block = line / factor
+            nb_blocks = (line + (count - max_lines + 1 if reverse else max_lines - count - 1)) / factor
+            nb_blocks = abs(nb_blocks - block) + 1
+            mismatch = numpy.flatnonzero(~is_match(_lines(block, reverse, nb_blocks)))
+            if len(mismatch) == 0:
+                return max_lines
+            if mismatch[0] > 0:
+                count += self._block_lines(line, reverse, int(mismatch[0]))
+                continue
+            # Not matching for sure: maybe not matching at all.
+            if is_mismatch(slice(block, block + 1))[0]:
+                return count
+            nb_lines = min(self._block_lines(line, reverse, 1), max_lines - count)
+            nb_matching = self._count_full_lines(want_bg, horizontal, line, reverse,
+                                                 seg_start, seg_len, nb_lines)
+            count += nb_matching
+            if nb_matching < nb_lines:
+                return count
+        return max_lines
+
+    def _count_full_lines(self, want_bg, horizontal, first_line, reverse, seg_start, seg_len, max_lines):
+        """ Same as count_lines, at full resolution. """
+        self._nb_checked_blocks += 1
+        if self._full_profiles is None and \
+           self._nb_checked_blocks > self._max_checked_blocks:
+            image = self._image.reshape(self._height, self._width)
+            self._full_profiles = LineProfiles(image, self._max_ignore_size)
+        if self._full_profiles is not None:
+            return self._full_profiles.count_lines(want_bg, horizontal, first_line, reverse,
+                                                   seg_start, seg_len, max_lines)
+        if horizontal:
+            step_size, line_pitch = 1, self._width
+        else:
+            step_size, line_pitch = self._width, 1
+        pos = seg_start * step_size + first_line * line_pitch
+        if reverse:
+            line_pitch = -line_pitch
+        return count_lines(self._image, self._max_ignore_size, want_bg, pos,
+                           step_size, seg_len, line_pitch, max_lines)
+
+
+def _reduce_blocks(fg, factor, op):
+    """ Reduce each <factor> x <factor> block of the 2D boolean array <fg>
+    (whose dimensions are multiples of <factor>) with <op>, a binary
+    numpy ufunc. Much faster than reshaping and reducing small axes. """
+    rows = fg[0::factor].copy()
+    for n in range(1, factor):
+        op(rows, fg[n::factor], out=rows)
+    blocks = rows[:, 0::factor].copy()
+    for n in range(1, factor):
+        op(blocks, rows[:, n::factor], out=blocks)
+    return blocks
+
+
+def _lines(first_line, reverse, nb_lines):
+    """ Return the slice of <nb_lines> lines from <first_line>, in
+    decreasing order if <reverse>. """
+    if reverse:
+        last_line = first_line - nb_lines
+        return slice(first_line, last_line if last_line >= 0 else None, -1)
+    return slice(first_line, first_line + nb_lines)
@@ -10,19 +10,31 @@ import operator
 
 NUMERIC_REGEXP = re.compile(r"\d+|\D+")  # Split into numerics and characters
 
+# Cache of alphanumeric_key results, cleared when it grows too big.
+_alphanumeric_keys = {}
+MAX_ALPHANUMERIC_KEYS = 65536
+
+
+def alphanumeric_key(s):
+    """Return the key for sorting <s> in alphanumeric order, i.e.
+    "1.jpg", "2.jpg", "10.jpg". Keys are cached, as the same strings
+    tend to be sorted and looked up over and over.
+    """
+    key = _alphanumeric_keys.get(s)
+    if key is None:
+        key = tuple([int(part) if part.isdigit() else part.lower()
+                     for part in NUMERIC_REGEXP.findall(s)])
+        if len(_alphanumeric_keys) >= MAX_ALPHANUMERIC_KEYS:
+            _alphanumeric_keys.clear()
+        _alphanumeric_keys[s] = key
+    return key
 
 def alphanumeric_sort(filenames):
     """Do an in-place alphanumeric sort of the strings in <filenames>,
     such that for an example "1.jpg", "2.jpg", "10.jpg" is a sorted
     ordering.
     """
-    def _format_substring(s):
-        if s.isdigit():
-            return int(s)
-
-        return s.lower()
-
-    filenames.sort(key=lambda s: map(_format_substring, NUMERIC_REGEXP.findall(s)))
+    filenames.sort(key=alphanumeric_key)
 
 def alphanumeric_compare(s1, s2):
     """ Compares two strings by their natural order (i.e. 1 before 10)
@@ -33,16 +45,7 @@ def alphanumeric_compare(s1, s2):
     elif s2 is None:
         return -1
 
-    stringparts1 = NUMERIC_REGEXP.findall(s1.lower())
-    stringparts2 = NUMERIC_REGEXP.findall(s2.lower())
-    for i, part in enumerate(stringparts1):
-        if part.isdigit():
-            stringparts1[i] = int(part)
-    for i, part in enumerate(stringparts2):
-        if part.isdigit():
-            stringparts2[i] = int(part)
-
-    return cmp(stringparts1, stringparts2)
+    return cmp(alphanumeric_key(s1), alphanumeric_key(s2))
 
 def bin_search(lst, value):
     """ Binary search for sorted list C{lst}, looking for C{value}.
@@ -119,6 +122,15 @@ def garbage_collect():
         gc.collect()
 
 
+def cpu_count():
+    """ Returns the number of CPUs, or 1 if it can't be determined. """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
 def div(a, b):
     return float(a) / float(b)
 
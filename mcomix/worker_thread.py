@@ -1,37 +1,59 @@
 """ Worker thread class. """
 from __future__ import with_statement
 
+import heapq
+import itertools
 import threading
 import traceback
 
 from mcomix import log
+from mcomix import tools
+
+# Marker for heap entries of orders removed from the queue (or moved to
+# another entry when reprioritized): cheaper than removing the entry.
+_REMOVED = object()
 
 class WorkerThread:
 
     def __init__(self, process_order, name=None, max_threads=1,
-                 sort_orders=False, unique_orders=False):
+                 sort_orders=False, unique_orders=False, batch_size=None):
         """Create a new pool of worker threads.
 
         Optional <name> will be added to spawned thread names.
         <process_order> will be called to process each work order.
-        At most <max_threads> will be started for processing.
-        If <sort_orders> is True, the orders queue will be sorted
-        after each addition. If <unique_orders> is True, duplicate
-        orders will not be added to the queue. """
+        At most <max_threads> will be started for processing (the number
+        of CPUs if None), see also set_max_threads.
+        Orders are processed by priority (lowest first, 0 if not
+        specified), and in FIFO order for the same priority, or sorted
+        order if <sort_orders> is True. If <unique_orders> is True,
+        duplicate orders will not be added to the queue: the priority of
+        the order already waiting is updated instead. If <batch_size> is
+        not None, <process_order> will be called with a list of up to
+        <batch_size> orders instead of a single order.
+
+        Orders must be hashable. """
         self._name = name
         self._process_order = process_order
-        self._max_threads = max_threads
+        self._max_threads = self._get_max_threads(max_threads)
         self._sort_orders = sort_orders
         self._unique_orders = unique_orders
+        self._batch_size = batch_size
         # If True, worker threads must stop immediately.
         self._stop_immediately = False
         # If True, worker threads must stop when queue is empty.
         self._stop_if_no_orders = False
         self._threads = []
-        # List of orders waiting for processing.
+        # Heap of [priority, sort key, order] entries waiting for processing.
         self._waiting_orders = []
-        # List of orders currently being processed.
-        self._processing_orders = []
+        self._nb_waiting_orders = 0
+        # Map unique orders to their entry in the heap.
+        self._waiting_entries = {}
+        self._sequence = itertools.count()
+        # Map orders currently being processed to their number of
+        # instances (more than one for duplicate orders).
+        self._processing_orders = {}
+        # Orders being processed that have been cancelled.
+        self._cancelled_orders = set()
         self._condition = threading.Condition()
 
     def __enter__(self):
@@ -40,9 +62,15 @@ class WorkerThread:
     def __exit__(self, exc_type, exc_value, traceback):
         return self._condition.__exit__(exc_type, exc_value, traceback)
 
+    @staticmethod
+    def _get_max_threads(max_threads):
+        if max_threads is None:
+            return tools.cpu_count()
+        return max(max_threads, 1)
+
     def _start(self, nb_threads=1):
         for n in range(nb_threads):
-            if len(self._threads) == self._max_threads:
+            if len(self._threads) >= self._max_threads:
                 break
             thread = threading.Thread(target=self._run)
             if self._name is not None:
@@ -51,68 +79,177 @@ class WorkerThread:
             thread.start()
             self._threads.append(thread)
 
+    def _push_order(self, order, priority):
+        """Queue <order>, return True if it was added (or reprioritized)."""
+        if priority is None:
+            priority = 0
+        if self._unique_orders:
+            if order in self._processing_orders:
+                if not order in self._cancelled_orders:
+                    return False
+                # Cancelled while being processed (which may already
+                # have been aborted): queue it again.
+                self._cancelled_orders.discard(order)
+            entry = self._waiting_entries.get(order)
+            if entry is not None:
+                if entry[0] == priority:
+                    return False
+                # Reprioritize: keep the old sort key, so orders with
+                # the same priority keep their relative order.
+                entry[2] = _REMOVED
+                entry = [priority, entry[1], order]
+                self._waiting_entries[order] = entry
+                heapq.heappush(self._waiting_orders, entry)
+                self._compact_orders()
+                return True
+        if self._sort_orders:
+            key = order
+        else:
+            key = self._sequence.next()
+        entry = [priority, key, order]
+        if self._unique_orders:
+            self._waiting_entries[order] = entry
+        heapq.heappush(self._waiting_orders, entry)
+        self._nb_waiting_orders += 1
+        return True
+
+    def _compact_orders(self):
+        """Drop removed entries from the heap if they use too much space."""
+        if len(self._waiting_orders) < 2 * self._nb_waiting_orders + 64:
+            return
+        self._waiting_orders = [entry for entry in self._waiting_orders
+                                if entry[2] is not _REMOVED]
+        heapq.heapify(self._waiting_orders)
+
+    def _pop_order(self):
+        """Return the waiting order with the highest priority."""
+        while True:
+            priority, key, order = heapq.heappop(self._waiting_orders)
+            if order is not _REMOVED:
+                break
+        if self._unique_orders:
+            del self._waiting_entries[order]
+        self._nb_waiting_orders -= 1
+        self._processing_orders[order] = self._processing_orders.get(order, 0) + 1
+        return order
+
+    def _processed_order(self, order):
+        count = self._processing_orders[order] - 1
+        if 0 == count:
+            del self._processing_orders[order]
+            self._cancelled_orders.discard(order)
+        else:
+            self._processing_orders[order] = count
+
     def _run(self):
-        order = None
+        orders = []
         while True:
             with self._condition:
-                if order is not None:
-                    self._processing_orders.remove(order)
-                while not self._stop_immediately and 0 == len(self._waiting_orders):
+                for order in orders:
+                    self._processed_order(order)
+                orders = []
+                while True:
+                    if self._stop_immediately:
+                        return
+                    if len(self._threads) > self._max_threads:
+                        # Pool was shrunk.
+                        self._threads.remove(threading.current_thread())
+                        return
+                    if self._nb_waiting_orders > 0:
+                        break
                     if self._stop_if_no_orders:
                         return
                     self._condition.wait()
-                if self._stop_immediately:
-                    return
-                order = self._waiting_orders.pop(0)
-                self._processing_orders.append(order)
+                orders = [self._pop_order()]
+                if self._batch_size is not None:
+                    while len(orders) < self._batch_size and \
+                          self._nb_waiting_orders > 0:
+                        orders.append(self._pop_order())
             try:
-                self._process_order(order)
+                if self._batch_size is None:
+                    self._process_order(orders[0])
+                else:
+                    self._process_order(orders)
             except Exception, e:
                 log.error('! Worker thread processing %(function)r failed: %(error)s',
                           { 'function' : self._process_order, 'error' : e })
                 log.debug('Traceback:\n%s', traceback.format_exc())
 
-    def must_stop(self):
-        """Return true if we've been asked to stop processing.
+    def set_max_threads(self, max_threads):
+        """Change the maximum number of worker threads (the number of CPUs
+        if None). When shrinking the pool, extra threads stop once done
+        with their current order."""
+        with self._condition:
+            self._max_threads = self._get_max_threads(max_threads)
+            self._start(nb_threads=self._nb_waiting_orders)
+            self._condition.notifyAll()
+
+    def set_batch_size(self, batch_size):
+        """Change the maximum number of orders passed at once to the
+        processing function, which must already be called with lists."""
+        with self._condition:
+            self._batch_size = batch_size
+
+    def must_stop(self, order=None):
+        """Return true if we've been asked to stop processing, or if
+        processing of <order> has been cancelled (see cancel_orders).
 
         Can be used by the processing function to check if it must abort early.
         """
-        return self._stop_immediately
+        if self._stop_immediately:
+            return True
+        return order is not None and order in self._cancelled_orders
 
     def clear_orders(self):
         """Clear the current orders queue."""
         with self._condition:
             self._waiting_orders = []
+            self._nb_waiting_orders = 0
+            self._waiting_entries = {}
+
+    def cancel_orders(self, orders=None):
+        """Remove <orders> (all orders if None) from the queue, and mark
+        those being processed as cancelled (see must_stop)."""
+        with self._condition:
+            if orders is None:
+                self.clear_orders()
+                self._cancelled_orders.update(self._processing_orders)
+                return
+            for order in orders:
+                if order in self._processing_orders:
+                    self._cancelled_orders.add(order)
+                if not self._unique_orders:
+                    for entry in self._waiting_orders:
+                        if entry[2] == order:
+                            entry[2] = _REMOVED
+                            self._nb_waiting_orders -= 1
+                    continue
+                entry = self._waiting_entries.pop(order, None)
+                if entry is not None:
+                    entry[2] = _REMOVED
+                    self._nb_waiting_orders -= 1
+            self._compact_orders()
 
-    def append_order(self, order):
+    def append_order(self, order, priority=None):
         """Append work order to the thread orders queue."""
         with self._condition:
-            if self._unique_orders:
-                if order in self._waiting_orders or \
-                   order in self._processing_orders:
-                    return
-            self._waiting_orders.append(order)
-            if self._sort_orders:
-                self._waiting_orders.sort()
+            if not self._push_order(order, priority):
+                return
             self._condition.notifyAll()
             self._start()
 
-    def extend_orders(self, orders):
-        """Append work orders to the thread orders queue."""
+    def extend_orders(self, orders, priorities=None):
+        """Append work orders to the thread orders queue. Optional
+        <priorities> must have the same length as <orders>."""
         with self._condition:
-            if self._unique_orders:
-                nb_added = 0
-                for o in orders:
-                    if o in self._waiting_orders or \
-                       o in self._processing_orders:
-                        continue
-                    self._waiting_orders.append(o)
+            if priorities is None:
+                priorities = itertools.repeat(None)
+            nb_added = 0
+            for order, priority in itertools.izip(orders, priorities):
+                if self._push_order(order, priority):
                     nb_added += 1
-            else:
-                self._waiting_orders.extend(orders)
-                nb_added = len(orders)
-            if self._sort_orders:
-                self._waiting_orders.sort()
+            if 0 == nb_added:
+                return
             self._condition.notifyAll()
             self._start(nb_threads=nb_added)
 
@@ -126,12 +263,16 @@ class WorkerThread:
             self._stop_immediately = True
         with self._condition:
             self._condition.notifyAll()
-        for thread in self._threads:
+            threads = list(self._threads)
+        for thread in threads:
             thread.join()
         self._threads = []
         self._stop_immediately = False
         self._stop_if_no_orders = False
         self._waiting_orders = []
-        self._processing_orders = []
+        self._nb_waiting_orders = 0
+        self._waiting_entries = {}
+        self._processing_orders = {}
+        self._cancelled_orders = set()
 
 # vim: expandtab:sw=4:ts=4